@@ -12,7 +12,10 @@ CREATE TABLE `messages` (
   `id` bigint(20) UNSIGNED NOT NULL,
   `parent` bigint(20) UNSIGNED DEFAULT NULL,
   `sender` varchar(32) NOT NULL,
-  `text` text NOT NULL
+  `text` text NOT NULL,
+  `summary` text DEFAULT NULL,
+  `preprocessed` text DEFAULT NULL,
+  `channel` bigint(20) UNSIGNED DEFAULT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
 CREATE TABLE `toolcalls` (
@@ -25,7 +28,9 @@ CREATE TABLE `toolcalls` (
 
 
 ALTER TABLE `messages`
-  ADD PRIMARY KEY (`id`);
+  ADD PRIMARY KEY (`id`),
+  ADD KEY `channel` (`channel`, `id`),
+  ADD KEY `parent` (`parent`);
 
 ALTER TABLE `toolcalls`
   ADD PRIMARY KEY (`id`);
@@ -1,5 +1,8 @@
-from .responses import ReplicateLlamaResponder
+from .responses import LlamaResponder, ReplicateLlamaResponder, LocalLlamaResponder
 from .images import ImagesManager
 from .mysql import MySQL
 from .message import Message
-from .config import AbbasConfig as Config
\ No newline at end of file
+from .config import AbbasConfig as Config
+from .tools import ToolExecutor
+from .scheduler import Scheduler
+from .resilience import ResilientCaller, CircuitOpenError
@@ -1,19 +1,33 @@
 import io
 import json
+import time
 import base64
 import asyncio
+from collections import OrderedDict, deque
 from abc import ABC, abstractmethod
 from urllib.parse import urlparse
 import httpx
 from PIL import Image
 
 class ImagesManager:
-    def __init__(self, blip_source: str, remote_blip_timeout: int, img_max_size: int, ocr: bool, tenor_apikey: str):
+    def __init__(self, blip_source: str, remote_blip_timeout: int, img_max_size: int, ocr: bool, tenor_apikey: str, *,
+                 cache_size: int = 512, precaption_budget: int = 60):
+        """
+        Args:
+            cache_size: number of captions kept in memory
+            precaption_budget: maximum number of images captioned in the background per hour
+        """
         self.blip_source = blip_source
         self.remote_blip_timeout = remote_blip_timeout
         self.img_max_size = img_max_size
         self.ocr = ocr
         self.tenor_apikey = tenor_apikey
+        self.cache_size = cache_size
+        self.precaption_budget = precaption_budget
+        self._captions: OrderedDict[str, str] = OrderedDict()
+        # captions being computed, so an image requested again while it's captioned isn't captioned twice
+        self._pending: dict[str, asyncio.Task] = {}
+        self._precaptioned: deque[float] = deque()
         
         if blip_source != "replicate":
             self.blip = LocalCaptioner(blip_source)
@@ -22,7 +36,81 @@ class ImagesManager:
         if ocr:
             self.ocr_engine = OCR(['en', 'pl'])
 
+    @staticmethod
+    def cache_key(url: str) -> str:
+        """Discord signs attachment links with expiring query parameters, the same image gets a new query every time"""
+        uri = urlparse(url)
+        if uri.hostname in ('cdn.discordapp.com', 'media.discordapp.net'):
+            return uri._replace(query='', fragment='').geturl()
+        return url
+
+    def cached_caption(self, url: str) -> str | None:
+        """Returns the caption of an image if it was already made, without captioning it"""
+        key = self.cache_key(url)
+        caption = self._captions.get(key)
+        if caption is not None:
+            self._captions.move_to_end(key)
+        return caption
+
     async def caption_image(self, url: str, ignore_errors: bool = True) -> str:
+        """
+        Describes an image using BLIP, captions are cached by image URL.
+        See _caption_image for details.
+
+        Args:
+            url: URL for the image. It will be downloaded and processed. Supports Tenor links
+            ignore_errors: return None if an exception occurs
+        Returns:
+            Caption describing the image
+        """
+        caption = self.cached_caption(url)
+        if caption is not None:
+            return caption
+        key = self.cache_key(url)
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._caption_image(url, False))
+            self._pending[key] = task
+            task.add_done_callback(lambda t: self._caption_done(key, t))
+        try:
+            # the captioning continues for other waiters if this one gets cancelled
+            return await asyncio.shield(task)
+        except RuntimeError:
+            if not ignore_errors:
+                raise
+            return None
+
+    def precaption(self, url: str) -> bool:
+        """
+        Starts captioning an image in the background, so the caption is ready if the image is mentioned later.
+        Does nothing if the image is already captioned or the hourly budget is used up.
+
+        Returns:
+            True if captioning was started
+        """
+        key = self.cache_key(url)
+        if key in self._captions or key in self._pending:
+            return False
+        now = time.monotonic()
+        while self._precaptioned and now - self._precaptioned[0] > 3600:
+            self._precaptioned.popleft()
+        if len(self._precaptioned) >= self.precaption_budget:
+            return False
+        self._precaptioned.append(now)
+        task = asyncio.create_task(self._caption_image(url, False))
+        self._pending[key] = task
+        task.add_done_callback(lambda t: self._caption_done(key, t))
+        return True
+
+    def _caption_done(self, key: str, task: asyncio.Task):
+        del self._pending[key]
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        self._captions[key] = task.result()
+        if len(self._captions) > self.cache_size:
+            self._captions.popitem(last=False)
+
+    async def _caption_image(self, url: str, ignore_errors: bool = True) -> str:
         """
         Describes an image using BLIP
         This routine downloads the image from the internet, scales it down to MAX_SIZE, converts it to PNG, and then sends to a BLIP captioner.
@@ -5,12 +5,19 @@ from uuid import uuid4
 from typing import Optional
 
 class Message:
-    def __init__(self, id: int, parent: Optional[int], sender: str, text: str = '', tool_calls: Optional[list[ToolCall]] = None):
+    def __init__(self, id: int, parent: Optional[int], sender: str, text: str = '', tool_calls: Optional[list[ToolCall]] = None, *,
+                 summary: Optional[str] = None, preprocessed: Optional[str] = None, channel: Optional[int] = None):
         self.id = id
         self.parent = parent
         self.sender = sender
         self.text = text
         self.tool_calls = tool_calls or []
+        # rolling summary of the conversation up to and including this message
+        self.summary = summary
+        # text of the Discord message with images replaced by captions, kept so retries don't caption again
+        self.preprocessed = preprocessed
+        # Discord channel the message was sent in, None for messages that aren't on Discord (tool calls)
+        self.channel = channel
     def __repr__(self) -> str:
         return f"Message(id={self.id!r}, parent={self.parent!r}, sender={self.sender!r}, text={self.text!r})"
     def __str__(self) -> str:
@@ -1,13 +1,20 @@
 import json
+import time
+import asyncio
 import mysql.connector.aio as mysql
 from .message import Message, ToolCall
 
+# first millisecond of 2015, the start of Discord IDs
+DISCORD_EPOCH = 1420070400000
+
 class MySQL:
     def __init__(self, **sql_auth):
         self.sql_auth = sql_auth
         self.db = None
         self.cur = None
         self.connected = False
+        # queries of different tasks can't interleave on the shared cursor
+        self._lock = asyncio.Lock()
     
     async def connect(self):
         """
@@ -26,22 +33,27 @@ class MySQL:
         """
         if not self.connected:
             raise RuntimeError("MySQL server not connected!")
-        await self._insert_message(message)
-        await self.db.commit()
+        async with self._lock:
+            await self._insert_message(message)
+            await self.db.commit()
     async def insert_messages(self, messages: list[Message]):
         """
         Insert multiple messages into database
         """
         if not self.connected:
             raise RuntimeError("MySQL server not connected!")
-        for message in messages:
-            if not isinstance(message, Message):
-                print(f"TypeError: insert_messages() requires abbas.message.Message, not {type(message)}")
-                continue
-            await self._insert_message(message)
-        await self.db.commit()
+        async with self._lock:
+            for message in messages:
+                if not isinstance(message, Message):
+                    print(f"TypeError: insert_messages() requires abbas.message.Message, not {type(message)}")
+                    continue
+                await self._insert_message(message)
+            await self.db.commit()
     async def _insert_message(self, message: Message):
-        await self.cur.execute("INSERT INTO `messages` VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE text=%s", (*message.tuple(), message.text))
+        await self.cur.execute("INSERT INTO `messages` (`id`, `parent`, `sender`, `text`, `summary`, `preprocessed`, `channel`) VALUES (%s, %s, %s, %s, %s, %s, %s) "
+                               "ON DUPLICATE KEY UPDATE text=%s, summary=COALESCE(%s, summary), preprocessed=COALESCE(%s, preprocessed), channel=COALESCE(%s, channel)",
+                               (*message.tuple(), message.summary, message.preprocessed, message.channel,
+                                message.text, message.summary, message.preprocessed, message.channel))
         if message.tool_calls:
             for tc in message.tool_calls:
                 await self.cur.execute("INSERT IGNORE INTO `toolcalls` VALUES (%s, %s, %s, %s, %s)", (tc.id, tc.name, json.dumps(tc.arguments), tc.result, message.id))
@@ -52,11 +64,15 @@ class MySQL:
         """
         if not self.connected:
             raise RuntimeError("MySQL server not connected!")
+        async with self._lock:
+            return await self._fetch_message_list(message_id)
+
+    async def _fetch_message_list(self, message_id: int) -> list[Message]:
         await self.cur.execute("""
                             WITH RECURSIVE cte AS (
-                            SELECT id, parent, sender, text FROM `messages` WHERE `id`=%s
+                            SELECT id, parent, sender, text, summary, preprocessed, channel FROM `messages` WHERE `id`=%s
                             UNION ALL
-                            SELECT m.id, m.parent, m.sender, m.text FROM messages m
+                            SELECT m.id, m.parent, m.sender, m.text, m.summary, m.preprocessed, m.channel FROM messages m
                             INNER JOIN cte
                                 ON m.id=cte.parent
                             )
@@ -68,5 +84,91 @@ class MySQL:
         for msg in result:
             await self.cur.execute("SELECT `id`, `name`, `arguments`, `result` FROM `toolcalls` WHERE `message_id`=%s", (msg[0],))
             toolcalls = await self.cur.fetchall()
-            ret.append(Message(*msg, [ToolCall(*x) for x in toolcalls]))
+            ret.append(self._message(msg, toolcalls))
         return ret
+
+    async def warm_up(self, max_conversations: int, max_age: float, max_length: int = 100) -> tuple[list[Message], dict[int, int]]:
+        """
+        Load the most recently active conversations in bulk.
+        A conversation ends with a bot message that wasn't replied to, branches of a conversation count separately.
+
+        Args:
+            max_conversations: maximum number of conversations loaded, the ones that ended last are loaded
+            max_age: only conversations that ended less than this many seconds ago are loaded
+            max_length: maximum number of messages loaded per conversation, counting from the newest
+        Returns:
+            tuple containing:
+            [0]: the loaded messages, in no particular order
+            [1]: ID of the newest bot message in each channel, by channel ID
+        """
+        if not self.connected:
+            raise RuntimeError("MySQL server not connected!")
+        async with self._lock:
+            return await self._warm_up(max_conversations, max_age, max_length)
+
+    async def _warm_up(self, max_conversations: int, max_age: float, max_length: int) -> tuple[list[Message], dict[int, int]]:
+        # Discord IDs start with the creation time in milliseconds since the Discord epoch
+        min_id = max(int((time.time() - max_age) * 1000) - DISCORD_EPOCH, 0) << 22
+        await self.cur.execute("""
+                            SELECT channel, MAX(id) FROM `messages`
+                            WHERE sender='assistant' AND channel IS NOT NULL AND id >= %s
+                            GROUP BY channel
+                        """, (min_id,))
+        last_messages = {channel: int(id) for channel, id in await self.cur.fetchall()}
+        await self.cur.execute("""
+                            SELECT id FROM `messages` m
+                            WHERE sender='assistant' AND channel IS NOT NULL AND id >= %s
+                                AND NOT EXISTS (SELECT 1 FROM `messages` c WHERE c.parent=m.id)
+                            ORDER BY id DESC LIMIT %s
+                        """, (min_id, max_conversations))
+        heads = [id for id, in await self.cur.fetchall()]
+        if not heads:
+            return [], last_messages
+
+        placeholders = ", ".join(["%s"] * len(heads))
+        await self.cur.execute(f"""
+                            WITH RECURSIVE cte AS (
+                            SELECT id, parent, sender, text, summary, preprocessed, channel, 1 AS depth FROM `messages` WHERE `id` IN ({placeholders})
+                            UNION ALL
+                            SELECT m.id, m.parent, m.sender, m.text, m.summary, m.preprocessed, m.channel, cte.depth+1 FROM messages m
+                            INNER JOIN cte
+                                ON m.id=cte.parent
+                            WHERE cte.depth < %s
+                            )
+                            SELECT id, parent, sender, text, summary, preprocessed, channel FROM cte;
+                        """, (*heads, max_length))
+        # conversations branching from the same message share their older part
+        rows = {msg[0]: msg for msg in await self.cur.fetchall()}
+        if not rows:
+            return [], last_messages
+
+        toolcalls: dict[int, list] = {}
+        placeholders = ", ".join(["%s"] * len(rows))
+        await self.cur.execute(f"SELECT `id`, `name`, `arguments`, `result`, `message_id` FROM `toolcalls` WHERE `message_id` IN ({placeholders})", tuple(rows))
+        for tc in await self.cur.fetchall():
+            toolcalls.setdefault(tc[4], []).append(tc[:4])
+        return [self._message(msg, toolcalls.get(msg[0], [])) for msg in rows.values()], last_messages
+
+    @staticmethod
+    def _message(row: tuple, toolcalls: list) -> Message:
+        return Message(*row[:4], [ToolCall(*x) for x in toolcalls], summary=row[4], preprocessed=row[5], channel=row[6])
+
+    async def update_summary(self, message_id: int, summary: str):
+        """
+        Store the rolling conversation summary of a message
+        """
+        if not self.connected:
+            raise RuntimeError("MySQL server not connected!")
+        async with self._lock:
+            await self.cur.execute("UPDATE `messages` SET `summary`=%s WHERE `id`=%s", (summary, message_id))
+            await self.db.commit()
+
+    async def clear_preprocessed(self, message_id: int):
+        """
+        Forget the preprocessed text of a message, after it was edited
+        """
+        if not self.connected:
+            raise RuntimeError("MySQL server not connected!")
+        async with self._lock:
+            await self.cur.execute("UPDATE `messages` SET `preprocessed`=NULL WHERE `id`=%s", (message_id,))
+            await self.db.commit()
@@ -0,0 +1,265 @@
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+from traceback import print_exc
+from typing import Callable, Optional
+
+DEFAULT_SYSTEM_PROMPT = "Jesteś bogaty szejk Abbas Baszir."
+
+class PromptAssets:
+    """
+    One version of the prompting files, with everything derived from them precomputed.
+    The loaded data is never modified, a new version replaces the old one when the files change.
+    """
+    def __init__(self, system_prompt: str, additional_contexts: list[dict], tools_prompt: str, encode: Callable[[str], tuple[int, ...]]):
+        self.system_prompt = system_prompt + tools_prompt
+        self.additional_contexts = additional_contexts
+        # (context, compiled trigger regexes) for each additional context
+        self.triggers = [
+            (context['context'], [re.compile(trigger, re.I) for trigger in context['trigger_words']])
+            for context in additional_contexts
+        ]
+        self.prefix = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{self.system_prompt}<|eot_id|>"
+        self.prefix_tokens = encode(self.prefix)
+        self.prefix_len = len(self.prefix_tokens)
+        # triggers with backreferences can't be combined into one regex, their group numbers would change
+        self._combinable = not any(
+            regex.groups and re.search(r'\\[1-9]|\(\?P=', regex.pattern)
+            for _, regexes in self.triggers for regex in regexes
+        )
+        self._matchers: dict[frozenset[int], Optional[re.Pattern]] = {}
+        self._matches: OrderedDict[int, tuple[str, list[str]]] = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def match_contexts(self, message_id: int, text: str, cache_size: int = 4096) -> list[str]:
+        """
+        Returns the additional contexts triggered by text, in the order they appear in additional_contexts.json.
+        Results are cached per message id.
+        """
+        with self._lock:
+            cached = self._matches.get(message_id)
+            if cached is not None and cached[0] == text:
+                self._matches.move_to_end(message_id)
+                return cached[1]
+        hits = self._scan(text)
+        contexts = [self.triggers[i][0] for i in sorted(hits)]
+        with self._lock:
+            self._matches[message_id] = (text, contexts)
+            if len(self._matches) > cache_size:
+                self._matches.popitem(last=False)
+        return contexts
+
+    def _scan(self, text: str) -> set[int]:
+        hits = set()
+        remaining = frozenset(range(len(self.triggers)))
+        while remaining:
+            matcher = self._matcher(remaining)
+            if matcher is None:
+                hits.update(i for i in remaining if any(regex.search(text) for regex in self.triggers[i][1]))
+                break
+            found = {int(match.lastgroup[1:]) for match in matcher.finditer(text)}
+            if not found:
+                break
+            # a match can hide an overlapping match of another context, rescan for the ones not found yet
+            hits |= found
+            remaining -= found
+        return hits
+
+    def _matcher(self, contexts: frozenset[int]) -> Optional[re.Pattern]:
+        """Combines triggers of the contexts into one regex with a named group for each context"""
+        if not self._combinable:
+            return None
+        with self._lock:
+            if contexts in self._matchers:
+                return self._matchers[contexts]
+        groups = []
+        for i in sorted(contexts):
+            triggers = '|'.join(f"(?:{regex.pattern})" for regex in self.triggers[i][1])
+            if triggers:
+                groups.append(f"(?P<c{i}>{triggers})")
+        matcher = None
+        if groups:
+            try:
+                matcher = re.compile('|'.join(groups), re.I)
+            except re.error:
+                pass
+        if matcher is None and groups:
+            self._combinable = False
+        with self._lock:
+            if len(self._matchers) > 64:
+                self._matchers.clear()
+            self._matchers[contexts] = matcher
+        return matcher
+
+class TokenCache:
+    """
+    LRU cache of token ids of rendered turns, so unchanged turns are never encoded twice
+
+    Args:
+        encode: Function returning token ids of a string
+        encode_batch: Function returning token ids of each of many strings, used by encode_many if provided
+    """
+    def __init__(self, encode: Callable[[str], list[int]], max_size: int = 8192, *,
+                 encode_batch: Optional[Callable[[list[str]], list[list[int]]]] = None):
+        self._encode = encode
+        self._encode_batch = encode_batch
+        self.max_size = max_size
+        self._data: OrderedDict[str, tuple[int, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def encode(self, text: str) -> tuple[int, ...]:
+        with self._lock:
+            tokens = self._data.get(text)
+            if tokens is not None:
+                self._data.move_to_end(text)
+                return tokens
+        tokens = tuple(self._encode(text))
+        self._store({text: tokens})
+        return tokens
+
+    def encode_many(self, texts: list[str]) -> list[tuple[int, ...]]:
+        """Returns token ids of each text, encoding all the uncached ones in one batch"""
+        found: dict[str, tuple[int, ...]] = {}
+        with self._lock:
+            for text in texts:
+                tokens = self._data.get(text)
+                if tokens is not None:
+                    self._data.move_to_end(text)
+                    found[text] = tokens
+        missing = list(dict.fromkeys(text for text in texts if text not in found))
+        if missing:
+            if self._encode_batch is not None and len(missing) > 1:
+                encoded = self._encode_batch(missing)
+            else:
+                encoded = [self._encode(text) for text in missing]
+            new = {text: tuple(tokens) for text, tokens in zip(missing, encoded)}
+            self._store(new)
+            found.update(new)
+        return [found[text] for text in texts]
+
+    def _store(self, items: dict[str, tuple[int, ...]]):
+        with self._lock:
+            for text, tokens in items.items():
+                self._data[text] = tokens
+                self._data.move_to_end(text)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+class RenderedPrompt:
+    """
+    A conversation rendered to turns, each with its text and token ids.
+    Every turn starts and ends with a special token, so joining the texts and concatenating
+    the token ids gives the same result as encoding the joined text.
+    """
+    def __init__(self, prefix: tuple[int, ...], suffix: tuple[int, ...]):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.turns: list[tuple[str, tuple[int, ...]]] = [] # newest to oldest
+        self.length = len(prefix) + len(suffix)
+        # messages that didn't fit, in the order of newest to oldest
+        self.evicted = []
+        # the oldest turn is a summary of the evicted messages
+        self.has_summary = False
+
+    def add(self, text: str, tokens: tuple[int, ...]):
+        """Adds a turn before the ones already added"""
+        self.turns.append((text, tokens))
+        self.length += len(tokens)
+
+    def pop(self) -> tuple[str, tuple[int, ...]]:
+        """Removes the oldest turn"""
+        text, tokens = self.turns.pop()
+        self.length -= len(tokens)
+        return text, tokens
+
+    def append(self, text: str, tokens: tuple[int, ...]):
+        """Adds a turn after the ones already added"""
+        self.turns.insert(0, (text, tokens))
+        self.length += len(tokens)
+
+    def trim(self, max_length: int):
+        """Removes the oldest turns until the prompt is shorter than max_length, keeping the summary and the newest turn"""
+        oldest = len(self.turns) - 1 - self.has_summary
+        while oldest > 0 and self.length >= max_length:
+            _, tokens = self.turns.pop(oldest)
+            self.length -= len(tokens)
+            oldest -= 1
+
+    @property
+    def text(self) -> str:
+        """The conversation without prefix and suffix, as sent in the prompt template"""
+        return ''.join(text for text, _ in reversed(self.turns))
+
+    @property
+    def tokens(self) -> list[int]:
+        """Token ids of the whole prompt, including prefix and suffix"""
+        tokens = list(self.prefix)
+        for _, turn in reversed(self.turns):
+            tokens.extend(turn)
+        tokens.extend(self.suffix)
+        return tokens
+
+class PromptFiles:
+    """
+    Loads system_prompt.txt and additional_contexts.json once and reloads them when their modification time changes.
+
+    Args:
+        tools_prompt: Text appended to the system prompt
+        encode: Function returning token ids of a string, used to precompute the prefix tokens
+    """
+    def __init__(self, tools_prompt: str, encode: Callable[[str], tuple[int, ...]], *,
+                 system_prompt_path: str = 'system_prompt.txt', additional_contexts_path: str = 'additional_contexts.json'):
+        self.tools_prompt = tools_prompt
+        self.encode = encode
+        self.system_prompt_path = system_prompt_path
+        self.additional_contexts_path = additional_contexts_path
+        self._current: Optional[tuple[tuple, PromptAssets]] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> PromptAssets:
+        """Returns the current version of the prompting files, reloading them if they changed on disk"""
+        mtimes = self._mtimes()
+        current = self._current
+        if current is not None and current[0] == mtimes:
+            return current[1]
+        with self._lock:
+            current = self._current
+            if current is not None and current[0] == mtimes:
+                return current[1]
+            try:
+                assets = self._load()
+            except Exception:
+                print("ERROR: Failed to load prompting files")
+                print_exc()
+                if current is not None:
+                    # keep using the previous version, don't retry until the files change again
+                    self._current = (mtimes, current[1])
+                    return current[1]
+                assets = PromptAssets(DEFAULT_SYSTEM_PROMPT, [], self.tools_prompt, self.encode)
+            if current is not None:
+                print("Reloaded prompting files")
+            self._current = (mtimes, assets)
+            return assets
+
+    def _mtimes(self) -> tuple[Optional[int], Optional[int]]:
+        def _mtime(path: str):
+            try:
+                return os.stat(path).st_mtime_ns
+            except OSError:
+                return None
+        return _mtime(self.system_prompt_path), _mtime(self.additional_contexts_path)
+
+    def _load(self) -> PromptAssets:
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+        if os.path.isfile(self.system_prompt_path):
+            with open(self.system_prompt_path, 'r', encoding='utf-8') as file:
+                system_prompt = file.read()
+        additional_contexts = []
+        if os.path.isfile(self.additional_contexts_path):
+            with open(self.additional_contexts_path, 'r', encoding='utf-8') as file:
+                o = json.loads(file.read())
+                if 'additional_contexts' in o:
+                    additional_contexts = o['additional_contexts']
+        return PromptAssets(system_prompt, additional_contexts, self.tools_prompt, self.encode)
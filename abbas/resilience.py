@@ -0,0 +1,295 @@
+import time
+import random
+import asyncio
+import contextlib
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the service while the circuit breaker is open"""
+
+class ResilientCaller:
+    """
+    Calls a remote service with per-attempt timeouts, retries, hedged requests and a circuit breaker.
+
+    Args:
+        timeout: seconds one attempt may take before it's cancelled
+        retries: number of extra attempts after a retryable error
+        backoff: base delay between retries in seconds, doubled with each retry, with full jitter
+        hedge_percentile: when an attempt takes longer than this percentile of recent latencies (0-1),
+                          a second request is sent and the first one to finish wins. None disables hedging
+        hedge_min_samples: number of recorded latencies needed before hedging starts
+        failure_threshold: consecutive failed attempts after which the circuit opens and calls fail fast
+        reset_timeout: seconds the circuit stays open before a single trial call is let through
+        retryable: predicate deciding if an exception is transient and the call can be retried
+    """
+    def __init__(self, *, timeout: float = 60, retries: int = 2, backoff: float = 1.0,
+                 hedge_percentile: Optional[float] = None, hedge_min_samples: int = 20,
+                 failure_threshold: int = 5, reset_timeout: float = 30,
+                 retryable: Optional[Callable[[BaseException], bool]] = None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retryable = retryable or (lambda e: isinstance(e, (TimeoutError, ConnectionError)))
+        self.latencies: deque[float] = deque(maxlen=200)
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def circuit_open(self) -> bool:
+        return self._opened_at is not None
+
+    async def call(self, attempt: Callable[[], Awaitable[T]], *, hedge: bool = True, record_success: bool = True) -> T:
+        """
+        Runs attempt until it succeeds, a non-retryable error is raised or the retries run out.
+
+        Args:
+            attempt: function starting one attempt, it gets cancelled when it times out or loses a hedge
+            hedge: allow hedged requests, only for attempts that are safe to run twice at once
+            record_success: False if the attempt only starts the work, like opening a stream.
+                            Its outcome is then recorded by the guard block reading the rest
+
+        Raises:
+            CircuitOpenError: the service failed too many times recently
+            The last error of the attempts otherwise
+        """
+        for retry in range(self.retries + 1):
+            if retry:
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (retry - 1)))
+            self._before_attempt()
+            try:
+                result = await self._attempt(attempt, hedge)
+            except asyncio.CancelledError:
+                self._trial = False
+                raise
+            except Exception as e:
+                if not self.retryable(e):
+                    # the service answered, it just didn't like the request
+                    self._on_success()
+                    raise
+                self._on_failure()
+                if retry == self.retries:
+                    raise
+                print(f"WARNING: Attempt {retry + 1} failed with {type(e).__name__}, retrying")
+                continue
+            if record_success:
+                self._on_success()
+            return result
+
+    @contextlib.asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        """
+        Bounds the rest of the work started by call(..., record_success=False) by the attempt timeout,
+        and records its outcome for the circuit breaker. A stalled stream counts as a failure.
+
+        Raises:
+            TimeoutError: the block took longer than the attempt timeout
+        """
+        try:
+            async with asyncio.timeout(self.timeout):
+                yield
+        except asyncio.CancelledError:
+            self._trial = False
+            raise
+        except Exception as e:
+            if self.retryable(e):
+                self._on_failure()
+            else:
+                self._on_success()
+            raise
+        self._on_success()
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds after which a hedged request is sent, None if hedging is off or there's not enough data"""
+        if self.hedge_percentile is None or len(self.latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * self.hedge_percentile), len(latencies) - 1)]
+
+    async def _attempt(self, attempt: Callable[[], Awaitable[T]], hedge: bool) -> T:
+        delay = self.hedge_delay() if hedge else None
+        started: dict[asyncio.Future, float] = {}
+        def start() -> asyncio.Future:
+            task = asyncio.ensure_future(asyncio.wait_for(attempt(), self.timeout))
+            started[task] = time.monotonic()
+            return task
+
+        pending = {start()}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    print(f"Request is taking longer than {delay:.2f}s, sending a hedged request")
+                    pending.add(start())
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if hedge:
+                            self.latencies.append(time.monotonic() - started[task])
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # the losing request gets cancelled so it doesn't keep running on the service
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _before_attempt(self):
+        if self._opened_at is None:
+            return
+        if time.monotonic() - self._opened_at < self.reset_timeout or self._trial:
+            raise CircuitOpenError("The service is unavailable, try again later")
+        # half open, let one call through to check if the service is back
+        self._trial = True
+
+    def _on_success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def _on_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if self._opened_at is None or self._trial:
+                print(f"WARNING: Circuit opened after {self.failures} consecutive failures")
+            self._opened_at = time.monotonic()
+            self._trial = False
+
+if __name__ == '__main__':
+    # checks ResilientCaller against a local fake prediction server: python abbas/resilience.py
+    async def main():
+        # behaviour of the next requests, "ok", "fail" (503), "stall" or "slow", then "ok" when empty
+        plan: list[str] = []
+        # stalled requests wait for this, they would keep the server open otherwise
+        released = asyncio.Event()
+
+        async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            path = (await reader.readline()).split()[1].decode()
+            while (await reader.readline()).strip():
+                pass
+            behaviour = plan.pop(0) if plan else "ok"
+            try:
+                if behaviour == "fail":
+                    writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n")
+                elif behaviour == "stall":
+                    await released.wait()
+                else:
+                    if behaviour == "slow":
+                        await asyncio.sleep(0.3)
+                    writer.write(b"HTTP/1.1 200 OK\r\n\r\n")
+                    for token in ("Hello", " there", "!"):
+                        writer.write(f"{token}\n".encode())
+                        await writer.drain()
+                        if path == "/stream" and behaviour == "slow":
+                            # stalls in the middle of the stream
+                            await released.wait()
+                            return
+                await writer.drain()
+            finally:
+                writer.close()
+
+        class ServerError(Exception):
+            pass
+
+        async def open_prediction(path: str) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+            writer.write(f"POST {path} HTTP/1.1\r\n\r\n".encode())
+            status = int((await reader.readline()).split()[1])
+            while (await reader.readline()).strip():
+                pass
+            if status != 200:
+                writer.close()
+                raise ServerError(status)
+            return reader, writer
+
+        async def predict() -> str:
+            reader, writer = await open_prediction("/predict")
+            try:
+                return (await reader.read()).decode().replace("\n", "")
+            finally:
+                writer.close()
+
+        def check(name: str, condition: bool):
+            print(f"{'ok  ' if condition else 'FAIL'} {name}")
+            if not condition:
+                failed.append(name)
+
+        failed = []
+        retryable = lambda e: isinstance(e, (TimeoutError, ConnectionError, ServerError))
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        async with server:
+            caller = ResilientCaller(timeout=0.5, retries=2, backoff=0.01, failure_threshold=3, reset_timeout=0.5, retryable=retryable)
+            check("success", await caller.call(predict) == "Hello there!")
+
+            plan[:] = ["fail", "stall"]
+            started = time.monotonic()
+            check("retries a server error and a timeout", await caller.call(predict) == "Hello there!")
+            check("timed out attempt was cancelled after the timeout", 0.5 <= time.monotonic() - started < 1.5)
+            check("success resets the failure count", caller.failures == 0)
+
+            plan[:] = ["fail"] * 3
+            try:
+                await caller.call(predict)
+                check("gives up after the retries", False)
+            except ServerError:
+                check("gives up after the retries", True)
+            check("circuit opens after consecutive failures", caller.circuit_open)
+            plan[:] = []
+            try:
+                await caller.call(predict)
+                check("open circuit fails fast", False)
+            except CircuitOpenError:
+                check("open circuit fails fast", True)
+            await asyncio.sleep(0.5)
+            check("half open circuit lets a trial call through", await caller.call(predict) == "Hello there!")
+            check("successful trial closes the circuit", not caller.circuit_open)
+
+            caller = ResilientCaller(timeout=2, retries=0, hedge_percentile=0.5, hedge_min_samples=5, retryable=retryable)
+            for _ in range(5):
+                await caller.call(predict)
+            plan[:] = ["stall"]
+            started = time.monotonic()
+            check("hedged request wins over a stalled one", await caller.call(predict) == "Hello there!")
+            check("hedge was sent before the timeout", time.monotonic() - started < 1)
+
+            caller = ResilientCaller(timeout=0.5, retries=1, backoff=0.01, failure_threshold=2, retryable=retryable)
+            for attempt in range(2):
+                plan[:] = ["slow"]
+                reader, writer = await caller.call(lambda: open_prediction("/stream"), record_success=False)
+                tokens = []
+                try:
+                    async with caller.guard():
+                        while line := await reader.readline():
+                            tokens.append(line.decode().strip())
+                    check("stalled stream times out", False)
+                except TimeoutError:
+                    check(f"stalled stream {attempt + 1} times out after the first token", tokens == ["Hello"])
+                finally:
+                    writer.close()
+            check("stalled streams open the circuit", caller.circuit_open)
+
+            caller = ResilientCaller(timeout=0.5, retryable=retryable)
+            plan[:] = ["stall"]
+            started = time.monotonic()
+            task = asyncio.create_task(caller.call(predict))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                check("cancelling the caller cancels the attempt", time.monotonic() - started < 0.3)
+            released.set()
+        print("FAILED: " + ", ".join(failed) if failed else "All checks passed")
+
+    asyncio.run(main())
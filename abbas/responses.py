@@ -1,10 +1,17 @@
 import os
-import re
-import json
 import random
 import asyncio
+import threading
+import contextlib
+from concurrent.futures import Future
+from traceback import print_exc
 from abc import ABC, abstractmethod
-from .message import Message
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from .message import Message, ToolCall
+from .prompts import PromptFiles, PromptAssets, RenderedPrompt, TokenCache
+from .resilience import ResilientCaller
+
+UpdateCallback = Callable[[str], Awaitable[None]]
 
 class Responder(ABC):
     @abstractmethod
@@ -12,13 +19,16 @@ class Responder(ABC):
         raise NotImplementedError
     
     @abstractmethod
-    async def generate_response(self, messages: list[Message]) -> tuple[dict, str]:
+    async def generate_response(self, messages: list[Message], *, on_update: Optional[UpdateCallback] = None) -> tuple[dict, str]:
         """Generates the next response in a conversation.
         The list of messages get encoded to a conversation, system prompt is read from ./system_prompt.txt,
         additional contexts from ./additional_contexts.json get applied, then conversation gets sent to model
 
         Args:
             messages: list of Message objects, in the order of newest to oldest
+            on_update: if provided, output is streamed and the callback is awaited with the text generated so far
+                       every time a new token arrives. Text of a tool call turn is also passed to the callback,
+                       the text of the next turn replaces it.
         Returns:
             tuple containing:
             [0]: input sent to the model containing the prompt and generation data
@@ -31,23 +41,6 @@ class Responder(ABC):
         """Returns the length of provided text in tokens, using the default tokenizer for model"""
         raise NotImplementedError
 
-    def load_prompting_files(self):
-        if os.path.isfile('system_prompt.txt'):
-            try:
-                with open('system_prompt.txt', 'r', encoding='utf-8') as file:
-                    system_prompt = file.read()
-            except OSError:
-                system_prompt = "Jesteś bogaty szejk Abbas Baszir."
-        if os.path.isfile('additional_contexts.json'):
-            try:
-                with open('additional_contexts.json', 'r', encoding='utf-8') as file:
-                    o = json.loads(file.read())
-                    if 'additional_contexts' in o:
-                        additional_contexts = o['additional_contexts']
-            except OSError:
-                additional_contexts = []
-        return system_prompt, additional_contexts
-    
     def is_zaposciany(self, messages: list[Message]) -> bool:
         for x in messages:
             if x.sender == 'assistant':
@@ -65,15 +58,26 @@ class Responder(ABC):
             temperature += lvl
         return temperature
 
-class ReplicateLlamaResponder(Responder):
-    def __init__(self, context_length: int, heating: bool, *, tokenizer_path: str = 'llama/tokenizer.model'):
-        import replicate
+class LlamaResponder(Responder):
+    """
+    Builds Llama 3 prompts, runs tools and streams the output.
+    Subclasses implement sending the prompt to a particular inference backend.
+    """
+    suffix = "<|start_header_id|>assistant<|end_header_id|>\n\n"
+    # number of messages rendered and encoded together when building the prompt
+    batch_size = 32
+
+    def __init__(self, context_length: int, heating: bool, *, tokenizer_path: str = 'llama/tokenizer.model', tool_executor = None,
+                 caller: Optional[ResilientCaller] = None):
         from .tools import LlamaToolsManager
-        from llama.tokenizer import Tokenizer
         self.context_length = context_length
+        self.caller = caller or ResilientCaller(retryable=self.is_retryable)
         self.heating = heating
-        self.tt = Tokenizer(tokenizer_path)
-        self.tools = LlamaToolsManager()
+        # may fork tool worker processes, which has to happen before the tokenizer thread starts
+        self.tools = LlamaToolsManager(executor=tool_executor)
+        # the tokenizer is built in the background, it's first needed when generating a response
+        self._tokenizer: Future = Future()
+        threading.Thread(target=self._load_tokenizer, args=(tokenizer_path,), name='tokenizer', daemon=True).start()
         self.tools_prompt = ""
         if len(self.tools.available_tools) > 0:
             self.tools_prompt = ("\n\nTool usage:\n"
@@ -85,37 +89,62 @@ class ReplicateLlamaResponder(Responder):
             "<|start_tool|>calculator(query=\"2+2\")<|end_tool|>")
             self.tools_prompt = self.tools_prompt.format(self.tools.describe_tools())
         print(f"Loaded {len(self.tools.available_tools)} tools: {", ".join(self.tools.available_tools)}")
+        self.turn_tokens = TokenCache(lambda text: self.tt.encode(text, bos=False, eos=False, allowed_special="all"),
+                                      encode_batch=lambda texts: self.tt.encode_batch(texts, bos=False, eos=False, allowed_special="all"))
+        self.prompts = PromptFiles(self.tools_prompt, self.turn_tokens.encode)
+
+    def _load_tokenizer(self, tokenizer_path: str):
+        try:
+            from llama.tokenizer import Tokenizer
+            self._tokenizer.set_result(Tokenizer(tokenizer_path))
+        except BaseException as e:
+            self._tokenizer.set_exception(e)
+
+    async def warm_up(self):
+        """Waits for the tokenizer and loads the prompting files, so the first response doesn't have to"""
+        await asyncio.wrap_future(self._tokenizer)
+        assets = await asyncio.to_thread(self.prompts.get)
+        if not await asyncio.to_thread(self._check_rendering, assets):
+            print("WARNING: Token ids of rendered turns don't match the encoded prompt, context length budgeting will be off")
+
+    def _check_rendering(self, assets: PromptAssets) -> bool:
+        """
+        Checks that the cached token ids of a rendered conversation are the same as encoding its whole text.
+        Budgeting counts the cached ids, while the backend gets the text.
+        """
+        messages = [
+            Message(-3, -2, 'user', " Ile to <|eot_id|> 2+2?\n"),
+            Message(-2, -1, 'assistant', '', [ToolCall(None, 'calculator', {'query': '2+2'}, "4")]),
+            Message(-1, None, 'user', "cześć  "),
+        ]
+        rendered = self._build_prompt(messages, assets)
+        text = self._summary_turn("Użytkownik się przywitał.")
+        rendered.add(text, self.turn_tokens.encode(text))
+        rendered.has_summary = True
+        expected = self.tt.encode(assets.prefix + rendered.text + self.suffix, bos=False, eos=False, allowed_special="all")
+        return rendered.tokens == expected
+
+    @property
+    def tt(self):
+        """The tokenizer, waits for it to finish loading"""
+        return self._tokenizer.result()
 
     # messages should be in order of newest to oldest
-    async def generate_response(self, messages: list[Message], recursion_depth=0) -> tuple[dict, str]:
-        import replicate
+    async def generate_response(self, messages: list[Message], recursion_depth=0, *, on_update: Optional[UpdateCallback] = None,
+                                _state: Optional[tuple[PromptAssets, RenderedPrompt]] = None) -> tuple[dict, str]:
         if recursion_depth > 2:
             raise RecursionError("Recursion depth reached while calling tool")
-        system_prompt, additional_contexts = self.load_prompting_files()
-        system_prompt += self.tools_prompt
-        prefix = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|>"
-        suffix = f"<|start_header_id|>assistant<|end_header_id|>\n\n"
-        prompt = ''
-        for msg in messages:
-            if msg.tool_calls:
-                tc = msg.tool_calls[0]
-                text = (f"<|start_header_id|>{msg.sender}<|end_header_id|>\n\n<|start_tool|>{tc.expression}<|end_tool|><|eot_id|>"
-                        f"<|start_header_id|>system<|end_header_id|>\n\nResponse:\n\n{tc.result}<|eot_id|>")
-            else:
-                if not msg.text:
-                    continue
-                text = f"<|start_header_id|>{msg.sender}<|end_header_id|>\n\n{msg.text}<|eot_id|>"
-                if msg.sender != 'assistant':
-                    for context in additional_contexts:
-                        for trigger in context['trigger_words']:
-                            regex = re.compile(trigger, re.I)
-                            match = regex.search(msg.text)
-                            if match:
-                                text = f"<|start_header_id|>system<|end_header_id|>\n\n{context['context']}<|eot_id|>{text}"
-                                break
-            if self.token_len(prefix + text + prompt + suffix) >= self.context_length:
-                break
-            prompt = text + prompt
+        if _state is None:
+            # don't block the event loop if the tokenizer is still loading
+            await asyncio.wrap_future(self._tokenizer)
+            assets = self.prompts.get()
+            rendered = self._build_prompt(messages, assets)
+        else:
+            # after a tool call the conversation is the same, except for the new tool turn
+            assets, rendered = _state
+        prefix = assets.prefix
+        suffix = self.suffix
+        prompt = rendered.text
 
         zaposciewanie = False
         temperature = 0.81
@@ -136,23 +165,19 @@ class ReplicateLlamaResponder(Responder):
         if zaposciewanie:
             input['presence_penalty'] = 0
             input['frequency_penalty'] = 0
-        output = await replicate.async_run(
-            "meta/meta-llama-3-70b-instruct",
-            input=input
-        )
-
-        # sometimes llama generates a wrong token, fix it if it's a minor mistake
-        correct_tokens = ['<', '|', 'start', '_tool', '|', '>']
-        len_correct = len(correct_tokens)-1
-        for i in range(len_correct, len(output)):
-            tokens = output[i-len_correct:i+1]
-            incorrect = [j+i-len_correct for j, token in enumerate(tokens) if token != correct_tokens[j]]
-            if len(incorrect) == 1:
-                output[i-len_correct:i+1] = correct_tokens
-                break
+        if on_update is None:
+            output = await self.caller.call(lambda: self._run(input))
+            self.repair_tool_tokens(output)
+        else:
+            output = await self._stream(input, on_update)
         
         text = "".join(output)
-        tool = await asyncio.to_thread(self.tools.parse_tool, text, asyncio.get_running_loop())
+        cancel = threading.Event()
+        try:
+            tool = await asyncio.to_thread(self.tools.parse_tool, text, asyncio.get_running_loop(), cancel)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
         if tool is not None:
             response_log = tool.result
             if "\n" in response_log:
@@ -161,12 +186,331 @@ class ReplicateLlamaResponder(Responder):
             print(tool.expression, "==>", response_log)
             if tool.result:
                 messages.insert(0, Message(Message.generate_id(messages), messages[0].id, 'assistant', tool_calls=[tool]))
-                return await self.generate_response(messages, recursion_depth+1)
+                text = self._render_message(messages[0], assets)
+                rendered.append(text, self.turn_tokens.encode(text))
+                rendered.trim(self.context_length)
+                return await self.generate_response(messages, recursion_depth+1, on_update=on_update, _state=(assets, rendered))
 
         return (input, text)
 
+    def _render_message(self, msg: Message, assets: PromptAssets) -> Optional[str]:
+        if msg.tool_calls:
+            tc = msg.tool_calls[0]
+            return (f"<|start_header_id|>{msg.sender}<|end_header_id|>\n\n<|start_tool|>{tc.expression}<|end_tool|><|eot_id|>"
+                    f"<|start_header_id|>system<|end_header_id|>\n\nResponse:\n\n{tc.result}<|eot_id|>")
+        if not msg.text:
+            return None
+        text = f"<|start_header_id|>{msg.sender}<|end_header_id|>\n\n{msg.text}<|eot_id|>"
+        if msg.sender != 'assistant':
+            for context in assets.match_contexts(msg.id, msg.text):
+                text = f"<|start_header_id|>system<|end_header_id|>\n\n{context}<|eot_id|>{text}"
+        return text
+
+    @staticmethod
+    def _summary_turn(summary: str) -> str:
+        return f"<|start_header_id|>system<|end_header_id|>\n\nSummary of the earlier conversation:\n{summary}<|eot_id|>"
+
+    def _build_prompt(self, messages: list[Message], assets: PromptAssets) -> RenderedPrompt:
+        """
+        Renders as many of the newest messages as fit in the context length.
+        If older messages don't fit, the newest summary stored on them is put at the start of the conversation.
+        Token ids of each turn are cached, so budgeting doesn't encode anything that was already seen.
+        """
+        rendered = RenderedPrompt(assets.prefix_tokens, self.turn_tokens.encode(self.suffix))
+        included: list[int] = [] # indices of messages in rendered turns
+        evicted_idx = len(messages)
+        for start in range(0, len(messages), self.batch_size):
+            # uncached turns of each batch are encoded together, at most one batch is encoded past the budget
+            batch = [(i, text) for i, text in enumerate(
+                (self._render_message(msg, assets) for msg in messages[start:start + self.batch_size]), start
+            ) if text is not None]
+            all_tokens = self.turn_tokens.encode_many([text for _, text in batch])
+            for (i, text), tokens in zip(batch, all_tokens):
+                if rendered.length + len(tokens) >= self.context_length:
+                    evicted_idx = i
+                    break
+                rendered.add(text, tokens)
+                included.append(i)
+            if evicted_idx < len(messages):
+                break
+        
+        summary = next((x.summary for x in messages[evicted_idx:] if x.summary), None)
+        if summary:
+            text = self._summary_turn(summary)
+            tokens = self.turn_tokens.encode(text)
+            # make space for the summary, but always keep the latest message
+            while len(included) > 1 and rendered.length + len(tokens) >= self.context_length:
+                rendered.pop()
+                evicted_idx = included.pop()
+            if rendered.length + len(tokens) < self.context_length:
+                rendered.add(text, tokens)
+                rendered.has_summary = True
+        
+        rendered.evicted = messages[evicted_idx:]
+        return rendered
+
+    async def summarize(self, messages: list[Message], max_chars: int = 12000) -> Optional[Message]:
+        """
+        Updates the rolling summary of the messages that no longer fit in the context.
+        The newest message that didn't fit gets a summary made from the previous summary and the messages after it.
+
+        Args:
+            messages: list of Message objects, in the order of newest to oldest
+            max_chars: maximum length of the new messages sent to the summarizer, older ones are skipped
+        Returns:
+            The message with the new summary, or None if the summary is already up to date
+        """
+        await asyncio.wrap_future(self._tokenizer)
+        assets = self.prompts.get()
+        evicted = self._build_prompt(messages, assets).evicted
+        if not evicted or evicted[0].summary:
+            return None
+        previous = None
+        lines = []
+        length = 0
+        for msg in evicted:
+            if msg.summary:
+                previous = msg.summary
+                break
+            if msg.tool_calls:
+                tc = msg.tool_calls[0]
+                line = f"{msg.sender} used tool {tc.expression}, result: {tc.result}"
+            elif msg.text:
+                line = f"{msg.sender}: {msg.text}"
+            else:
+                continue
+            length += len(line)
+            if length > max_chars:
+                break
+            lines.append(line)
+        
+        system_prompt = ("You keep a running summary of a chat conversation. "
+                         "Given the previous summary and the messages that came after it, write an updated summary. "
+                         "Keep names, facts and open questions, skip small talk. Answer with the summary only, in at most 150 words.")
+        prefix = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|>"
+        prompt = f"Previous summary:\n{previous or '(none)'}\n\nNew messages:\n" + "\n".join(reversed(lines))
+        input = {
+            "prompt": prompt,
+            "prompt_template": f"{prefix}<|start_header_id|>user<|end_header_id|>\n\n{{prompt}}<|eot_id|>{self.suffix}",
+            "max_tokens": 300,
+            "temperature": 0.3
+        }
+        output = await self.caller.call(lambda: self._run(input), hedge=False)
+        evicted[0].summary = "".join(output).strip()
+        return evicted[0]
+
+    @abstractmethod
+    async def _run(self, input: dict) -> list[str]:
+        """Generates the whole output at once, cancelling the generation if the call gets cancelled"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _stream_tokens(self, input: dict) -> AsyncIterator[str]:
+        """
+        Async generator of the output tokens, closing it stops the generation.
+        Starts the generation with caller.call(..., record_success=False), then yields an empty string before the first token.
+        """
+        raise NotImplementedError
+
+    async def _stream(self, input: dict, on_update: UpdateCallback) -> list[str]:
+        """
+        Streams the output, repairing tool tokens as they arrive.
+        The generation is stopped as soon as a complete tool call is generated.
+        """
+        output = []
+        repaired = False
+        async with contextlib.aclosing(self._stream_tokens(input)) as tokens:
+            # starting the generation is retried by the caller, reading the output can't be
+            await anext(tokens, None)
+            async with self.caller.guard():
+                async for token in tokens:
+                    output.append(token)
+                    if not repaired:
+                        repaired = self.repair_tool_tokens(output, len(output)-1)
+                    text = "".join(output)
+                    await on_update(text)
+                    start = text.find('<|start_tool|>')
+                    if start != -1 and text.find('<|end_tool|>', start) != -1:
+                        # the rest of the generation would be thrown away, run the tool now
+                        break
+        return output
+
+    @staticmethod
+    def is_retryable(e: BaseException) -> bool:
+        """Transient errors: timeouts and connection problems"""
+        import httpx
+        return isinstance(e, (TimeoutError, httpx.TransportError))
+
+    @staticmethod
+    def repair_tool_tokens(output: list[str], start: int = 5) -> bool:
+        """
+        Sometimes llama generates a wrong token, fix it if it's a minor mistake.
+        Fixes the first window of tokens that differs from "<|start_tool|>" by a single token, ending at index start or later.
+
+        Returns:
+            True if a window was fixed
+        """
+        correct_tokens = ['<', '|', 'start', '_tool', '|', '>']
+        len_correct = len(correct_tokens)-1
+        for i in range(max(start, len_correct), len(output)):
+            tokens = output[i-len_correct:i+1]
+            incorrect = [j+i-len_correct for j, token in enumerate(tokens) if token != correct_tokens[j]]
+            if len(incorrect) == 1:
+                output[i-len_correct:i+1] = correct_tokens
+                return True
+        return False
+
     def token_len(self, text: str) -> str:
         return len(self.tt.encode(text, bos=False, eos=False, allowed_special="all"))
+
+class ReplicateLlamaResponder(LlamaResponder):
+    """Generates responses with Llama 3 70B Instruct on Replicate"""
+    def __init__(self, context_length: int, heating: bool, **kwargs):
+        import replicate
+        super().__init__(context_length, heating, **kwargs)
+
+    async def _run(self, input: dict) -> list[str]:
+        import replicate
+        from replicate.exceptions import ModelError
+        prediction = await replicate.models.predictions.async_create(
+            model="meta/meta-llama-3-70b-instruct",
+            input=input
+        )
+        try:
+            await prediction.async_wait()
+        except asyncio.CancelledError:
+            try:
+                await prediction.async_cancel()
+            except Exception:
+                print_exc()
+            raise
+        if prediction.status == "failed":
+            raise ModelError(prediction)
+        if prediction.status == "canceled":
+            raise RuntimeError("Prediction was cancelled")
+        return list(prediction.output or [])
+
+    async def _stream_tokens(self, input: dict) -> AsyncIterator[str]:
+        import replicate
+        # streamed output is shown as it arrives, so only starting the prediction can be retried
+        prediction = await self.caller.call(lambda: replicate.models.predictions.async_create(
+            model="meta/meta-llama-3-70b-instruct",
+            input=input,
+            stream=True
+        ), hedge=False, record_success=False)
+        finished = False
+        try:
+            yield ""
+            async for event in prediction.async_stream():
+                token = str(event) # empty for non-output events
+                if token:
+                    yield token
+            finished = True
+        finally:
+            if not finished:
+                try:
+                    await prediction.async_cancel()
+                except Exception:
+                    print_exc()
+
+    @staticmethod
+    def is_retryable(e: BaseException) -> bool:
+        """Transient errors: timeouts, connection problems, rate limits, server errors and failed predictions"""
+        import httpx
+        from replicate.exceptions import ModelError, ReplicateError
+        if isinstance(e, ReplicateError):
+            return e.status is None or e.status == 429 or e.status >= 500
+        return isinstance(e, (TimeoutError, ModelError, httpx.TransportError))
+
+class LocalLlamaResponder(LlamaResponder):
+    """
+    Generates responses with a local inference server implementing OpenAI's completions API,
+    like llama.cpp server or vLLM. The server has to run a Llama 3 Instruct model.
+
+    Args:
+        url: Base URL of the server, /v1/completions is appended to it
+        model: Model name sent with requests, needed by servers hosting more than one model
+        max_connections: Maximum number of connections kept open to the server
+    """
+    stop = ["<|eot_id|>", "<|end_of_text|>"]
+
+    def __init__(self, context_length: int, heating: bool, *, url: str = 'http://127.0.0.1:8080', model: Optional[str] = None,
+                 max_connections: int = 8, **kwargs):
+        import httpx
+        super().__init__(context_length, heating, **kwargs)
+        self.model = model
+        # one client for all requests, so connections to the server are reused
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            timeout=httpx.Timeout(10, read=120),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    def _body(self, input: dict, stream: bool) -> dict:
+        # the server gets the whole prompt, with the same template Replicate would apply
+        prompt = input["prompt_template"].replace("{prompt}", input["prompt"])
+        body = {
+            # the server adds <|begin_of_text|> to the prompt itself
+            "prompt": prompt.removeprefix("<|begin_of_text|>"),
+            "max_tokens": input["max_tokens"],
+            "temperature": input["temperature"],
+            "stop": self.stop,
+            "stream": stream
+        }
+        for key in ("presence_penalty", "frequency_penalty"):
+            if key in input:
+                body[key] = input[key]
+        if self.model:
+            body["model"] = self.model
+        return body
+
+    async def _run(self, input: dict) -> list[str]:
+        # a cancelled request closes the connection, which stops the generation on the server
+        response = await self.client.post("/v1/completions", json=self._body(input, False))
+        response.raise_for_status()
+        return self._split_tokens(response.json()["choices"][0]["text"])
+
+    def _split_tokens(self, text: str) -> list[str]:
+        """Splits the generated text into the model's tokens, the same way Replicate returns its output"""
+        tokens = self.tt.encode(text, bos=False, eos=False)
+        text, offsets = self.tt.model.decode_with_offsets(tokens)
+        # a character split over several tokens is part of the last one, the others are empty
+        return [text[start:end] for start, end in zip(offsets, [*offsets[1:], len(text)])]
+
+    async def _send_stream(self, body: dict):
+        response = await self.client.send(self.client.build_request("POST", "/v1/completions", json=body), stream=True)
+        if response.is_error:
+            await response.aread()
+            await response.aclose()
+            response.raise_for_status()
+        return response
+
+    async def _stream_tokens(self, input: dict) -> AsyncIterator[str]:
+        import json
+        body = self._body(input, True)
+        response = await self.caller.call(lambda: self._send_stream(body), hedge=False, record_success=False)
+        try:
+            yield ""
+            async for line in response.aiter_lines():
+                # server-sent events, one completion chunk per data line
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                token = json.loads(data)["choices"][0]["text"]
+                if token:
+                    yield token
+        finally:
+            await response.aclose()
+
+    @staticmethod
+    def is_retryable(e: BaseException) -> bool:
+        """Transient errors: timeouts, connection problems, rate limits and server errors"""
+        import httpx
+        if isinstance(e, httpx.HTTPStatusError):
+            return e.response.status_code == 429 or e.response.status_code >= 500
+        return isinstance(e, (TimeoutError, httpx.TransportError))
     
 if __name__ == '__main__':
     async def main():
@@ -0,0 +1,108 @@
+import time
+import asyncio
+import contextlib
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Optional
+
+class Scheduler:
+    """
+    Admission control for responses, limits how many of them run at the same time.
+
+    Waiting requests are served first come first served within a channel,
+    and channels take turns so that one busy channel can't starve the others.
+    Priority requests (slash command interactions, which have to answer before Discord's deadline)
+    are served before all others.
+
+    Args:
+        max_concurrent: maximum number of slots held at the same time
+    """
+    def __init__(self, max_concurrent: int = 4):
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self._priority: deque[asyncio.Future] = deque()
+        # channels with waiting requests, in the order they get their next turn
+        self._channels: OrderedDict[int, deque[asyncio.Future]] = OrderedDict()
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._priority) + sum(len(queue) for queue in self._channels.values())
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'queued': self.queue_depth,
+            'waited': self.waited,
+            'average_wait': self.total_wait / self.waited if self.waited else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self, channel_id: int, *, priority: bool = False) -> AsyncIterator[float]:
+        """
+        Waits for a free slot and holds it until the block exits.
+        Yields the number of seconds spent waiting in the queue.
+        """
+        waited = await self._acquire(channel_id, priority)
+        try:
+            yield waited
+        finally:
+            self._release()
+
+    async def _acquire(self, channel_id: int, priority: bool) -> float:
+        if self.running < self.max_concurrent and self.queue_depth == 0:
+            self.running += 1
+            return 0.0
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        if priority:
+            self._priority.append(future)
+        else:
+            self._channels.setdefault(channel_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was granted right before the cancellation, pass it on
+                self._release()
+            else:
+                self._remove(future, channel_id, priority)
+            raise
+        waited = time.monotonic() - started
+        self.waited += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def _release(self):
+        self.running -= 1
+        while self.running < self.max_concurrent:
+            future = self._next()
+            if future is None:
+                return
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    def _next(self) -> Optional[asyncio.Future]:
+        if self._priority:
+            return self._priority.popleft()
+        if not self._channels:
+            return None
+        channel_id, queue = self._channels.popitem(last=False)
+        future = queue.popleft()
+        if queue:
+            # the channel goes to the back of the line for its next request
+            self._channels[channel_id] = queue
+        return future
+
+    def _remove(self, future: asyncio.Future, channel_id: int, priority: bool):
+        queue = self._priority if priority else self._channels.get(channel_id)
+        if queue is None:
+            return
+        with contextlib.suppress(ValueError):
+            queue.remove(future)
+        if not priority and not queue:
+            del self._channels[channel_id]
@@ -1,34 +1,113 @@
+from __future__ import annotations
 import os
 import ast
 import inspect
 import asyncio
+import threading
 import importlib
 import importlib.util
 from traceback import print_exc
 from abc import ABC, abstractmethod
 from ..message import ToolCall
+from ._executor import ToolExecutor
 from typing import Callable, Optional
 
+class Tool:
+    """
+    A tool from the tools directory.
+    Its signature and docstring are read from the module source without importing it,
+    the module is imported the first time the tool is called.
+    """
+    def __init__(self, name: str, signature: str, parameters: list[str], doc: Optional[str], *, function: Optional[Callable] = None):
+        self.name = name
+        self.signature = signature
+        self.parameters = parameters
+        self.doc = doc
+        self._function = function
+    
+    @property
+    def function(self) -> Callable:
+        if self._function is None:
+            module = importlib.import_module('.' + self.name, __name__)
+            self._function = getattr(module, self.name)
+        return self._function
+    
+    def __call__(self, *args, **kwargs):
+        return self.function(*args, **kwargs)
+    
+    def __repr__(self) -> str:
+        return f"Tool(name={self.name!r}, signature={self.signature!r}, loaded={self._function is not None})"
+
+    @classmethod
+    def from_source(cls, name: str, path: str) -> Tool:
+        with open(path, 'r', encoding='utf-8') as file:
+            tree = ast.parse(file.read(), path)
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == name:
+                return cls(name, _format_arguments(node.args), _argument_names(node.args), ast.get_docstring(node))
+        # not a plain function definition (eg. imported or assigned), fall back to importing it
+        return cls.from_function(getattr(importlib.import_module('.' + name, __name__), name))
+    
+    @classmethod
+    def from_function(cls, function: Callable) -> Tool:
+        sig = inspect.signature(function)
+        params = [param.replace(default=inspect.Parameter.empty) for param in sig.parameters.values()]
+        sig = sig.replace(parameters=params, return_annotation=inspect.Signature.empty)
+        return cls(function.__name__, str(sig), list(sig.parameters.keys()), inspect.getdoc(function), function=function)
+
+def _format_arguments(args: ast.arguments) -> str:
+    """Formats function arguments like str(inspect.Signature) would, without defaults and return annotation"""
+    def _format(arg: ast.arg):
+        if arg.annotation is None:
+            return arg.arg
+        return f"{arg.arg}: {ast.unparse(arg.annotation)}"
+    params = []
+    for i, arg in enumerate(args.posonlyargs + args.args):
+        params.append(_format(arg))
+        if i == len(args.posonlyargs) - 1:
+            params.append('/')
+    if args.vararg:
+        params.append('*' + _format(args.vararg))
+    elif args.kwonlyargs:
+        params.append('*')
+    params += [_format(x) for x in args.kwonlyargs]
+    if args.kwarg:
+        params.append('**' + _format(args.kwarg))
+    return f"({', '.join(params)})"
+
+def _argument_names(args: ast.arguments) -> list[str]:
+    names = [x.arg for x in args.posonlyargs + args.args]
+    if args.vararg:
+        names.append(args.vararg.arg)
+    names += [x.arg for x in args.kwonlyargs]
+    if args.kwarg:
+        names.append(args.kwarg.arg)
+    return names
+
 class ToolsManager(ABC):
-    def __init__(self, *, print_errors: bool = True):
+    def __init__(self, *, print_errors: bool = True, executor: Optional[ToolExecutor] = None):
         self.print_errors = print_errors
+        if executor is None:
+            executor = ToolExecutor()
+            # create managers before starting threads, the worker processes are forked here
+            executor.start()
+        self.executor = executor
         tools_dir = os.path.dirname(__file__)
-        self.available_tools = {}
+        self.available_tools: dict[str, Tool] = {}
         for file in os.listdir(tools_dir):
             if file.startswith('_'):
                 continue
             if not file.endswith('.py'):
                 continue
             tool = file.rsplit('.py', 1)[0]
-            module = importlib.import_module('.' + tool, __name__)
-            self.available_tools[tool] = getattr(module, tool)
+            self.available_tools[tool] = Tool.from_source(tool, os.path.join(tools_dir, file))
     
     @abstractmethod
     def describe_tools(self) -> str:
         raise NotImplementedError
     
     @abstractmethod
-    def parse_tool(self, text, loop: Optional[asyncio.AbstractEventLoop] = None) -> ToolCall | None:
+    def parse_tool(self, text, loop: Optional[asyncio.AbstractEventLoop] = None, cancel: Optional[threading.Event] = None) -> ToolCall | None:
         """
         Parse and execute a tool.
 
@@ -39,6 +118,8 @@ class ToolsManager(ABC):
 
             loop: The running asyncio tool to execute async tools in.
                   If not provided, a new loop will be created and ran.
+            
+            cancel: Event that aborts the running tool when set.
         
         Returns:
             ToolCall object containing the function call and its result
@@ -46,38 +127,26 @@ class ToolsManager(ABC):
         
         Notes:
             Thread creation is the responsibility of the caller.
+            The tool itself runs in the executor and blocks the calling thread until it finishes.
             A tool can be either sync or async.
+            If a tool times out or gets cancelled, the returned ToolCall contains the error as its result.
         """
         raise NotImplementedError
 
-    def _run_tool(self, target: Callable, args: tuple, kwargs: dict, loop: Optional[asyncio.AbstractEventLoop]):
-        if inspect.iscoroutinefunction(target):
-            if not loop:
-                loop = asyncio.new_event_loop()
-            if not loop.is_running():
-                return loop.run_until_complete(target(*args, **kwargs))
-            else:
-                future = asyncio.run_coroutine_threadsafe(target(*args, **kwargs), loop)
-                return future.result()
-        else:
-            return target(*args, **kwargs)
+    def _run_tool(self, name: str, target: Callable, args: tuple, kwargs: dict,
+                  loop: Optional[asyncio.AbstractEventLoop], cancel: Optional[threading.Event] = None):
+        return self.executor.run(name, target, args, kwargs, loop, cancel)
 
 
 class LlamaToolsManager(ToolsManager):
     def describe_tools(self) -> str:
         tools = []
         for tool in self.available_tools.values():
-            name = tool.__name__
-            sig = inspect.signature(tool)
-            params = []
-            for param in sig.parameters.values():
-                params.append(param.replace(default=inspect.Parameter.empty))
-            sig = sig.replace(parameters=params, return_annotation=inspect.Signature.empty)
-            doc = inspect.getdoc(tool) or "No description available"
-            tools.append(f"{name}{sig} - {doc}")
+            doc = tool.doc or "No description available"
+            tools.append(f"{tool.name}{tool.signature} - {doc}")
         return "\n".join(tools)
     
-    def parse_tool(self, text: str, loop: asyncio.AbstractEventLoop | None = None) -> ToolCall | None:
+    def parse_tool(self, text: str, loop: asyncio.AbstractEventLoop | None = None, cancel: threading.Event | None = None) -> ToolCall | None:
         idx = text.find('<|start_tool|>')
         if idx == -1:
             return None
@@ -89,9 +158,9 @@ class LlamaToolsManager(ToolsManager):
         tool = text[idx:idx2]
         if not tool:
             return None
-        return self._parse_tool(tool, loop)
+        return self._parse_tool(tool, loop, cancel)
     
-    def _parse_tool(self, tool: str, loop: Optional[asyncio.AbstractEventLoop]):
+    def _parse_tool(self, tool: str, loop: Optional[asyncio.AbstractEventLoop], cancel: Optional[threading.Event] = None):
         name, tc_arguments = tool, None
         try:
             tree = ast.parse(tool, mode='eval')
@@ -115,10 +184,9 @@ class LlamaToolsManager(ToolsManager):
             args = tuple(x.value for x in tree.body.args)
             kwargs = {x.arg: x.value.value for x in tree.body.keywords}
 
-            sig = inspect.signature(target)
-            tc_arguments = {k: v for k, v in zip(sig.parameters.keys(), args)}
+            tc_arguments = {k: v for k, v in zip(target.parameters, args)}
             tc_arguments.update(kwargs)
-            ret = self._run_tool(target, args, kwargs, loop)
+            ret = self._run_tool(name, target.function, args, kwargs, loop, cancel)
         except Exception as e:
             if self.print_errors:
                 print(f"Exception while calling tool {tool}:")
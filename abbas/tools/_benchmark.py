@@ -0,0 +1,111 @@
+"""
+Compares the calculator with the evaluator it used before queries were compiled and cached,
+on queries like the ones the model sends, and checks that both return the same results.
+
+Usage: python -m abbas.tools._benchmark
+"""
+import ast
+import math
+import time
+from typing import Callable
+
+from . import calculator as calc
+
+QUERIES = [
+    "2+2",
+    "15*37.5/100",
+    "sqrt(144)",
+    "2**64",
+    "factorial(20)",
+    "sin(pi/4)*cos(pi/3)",
+    "log(1000, 10)",
+    "(1+0.05)**10*1000",
+    "comb(52, 5)",
+    "abs(-17) % 5",
+    "1 << 20",
+    "1/0",
+    "floor(3.7) + ceil(2.1)",
+    "hypot(3, 4)",
+]
+
+def _calculator_before(query: str):
+    """The calculator before queries were compiled, parses, validates and walks the tree on every call"""
+    locals = {x: getattr(math, x) for x in dir(math) if not x.startswith('_')}
+    locals['abs'] = abs
+    tree = ast.parse(query, mode='eval')
+    calc._validate(tree)
+
+    def _evaluate(node):
+        if isinstance(node, ast.Constant):
+            result = node.value
+        elif isinstance(node, ast.Name):
+            result = locals[node.id]
+        elif isinstance(node, ast.Expression):
+            result = _evaluate(node.body)
+        elif isinstance(node, ast.Call):
+            target = node.func.id
+            args = tuple(_evaluate(x) for x in node.args)
+            kwargs = {x.arg: _evaluate(x.value) for x in node.keywords}
+            if target == 'factorial':
+                if args[0] > calc.MAX_FACTORIAL:
+                    raise OverflowError
+            if target == 'comb' or target == 'perm':
+                if (target == 'comb' and len(args) == 2
+                    or target == 'perm' and 1 <= len(args) <= 2):
+                    if len(args) >= 2 and args[1] > args[0]:
+                        return 0
+                    if any(x > calc.MAX_FACTORIAL for x in args):
+                        raise OverflowError
+            locals_ = locals.copy()
+            locals_.update({'target': locals[target], 'args': args, 'kwargs': kwargs})
+            result = eval("target(*args, **kwargs)", {'__builtins__': None}, locals_)
+        elif isinstance(node, ast.UnaryOp):
+            result = calc._ops[type(node.op)](_evaluate(node.operand))
+        elif isinstance(node, ast.BinOp):
+            left = _evaluate(node.left)
+            right = _evaluate(node.right)
+            if isinstance(node.op, ast.Pow):
+                if abs(left) > calc.MAX_POW or abs(right) > calc.MAX_POW:
+                    raise OverflowError
+            if isinstance(node.op, ast.LShift):
+                if right > calc.MAX_LSHIFT:
+                    raise OverflowError
+            result = calc._ops[type(node.op)](left, right)
+        else:
+            raise ValueError(f"Invalid ast node? {type(node).__name__}")
+        if abs(result) > calc.MAX_VALUE:
+            raise OverflowError
+        return result
+
+    try:
+        return _evaluate(tree)
+    except (ZeroDivisionError, OverflowError):
+        return math.inf
+
+def throughput(calculator: Callable, queries: list[str], min_time: float = 1.0) -> float:
+    """Queries evaluated per second"""
+    rounds = 0
+    started = time.perf_counter()
+    while True:
+        for query in queries:
+            calculator(query)
+        rounds += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return len(queries) * rounds / elapsed
+
+def main():
+    # the same query again (retries, regenerated replies) hits the compiled query cache, new numbers don't
+    unique = [f"{query} + {i}" for i in range(200) for query in QUERIES]
+    for query in QUERIES + unique:
+        before, after = _calculator_before(query), calc.calculator(query)
+        if before != after and not (isinstance(before, float) and math.isclose(before, after)):
+            raise AssertionError(f"Results differ for {query}: {before} != {after}")
+    for name, queries in (("repeated queries", QUERIES), ("unique queries", unique)):
+        old = throughput(_calculator_before, queries)
+        calc._compile.cache_clear()
+        new = throughput(calc.calculator, queries)
+        print(f"{name:<18} before: {old:9.0f} queries/s   compiled: {new:9.0f} queries/s   {new / old:5.2f}x")
+
+if __name__ == "__main__":
+    main()
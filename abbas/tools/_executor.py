@@ -0,0 +1,268 @@
+import os
+import time
+import queue
+import signal
+import asyncio
+import inspect
+import threading
+import multiprocessing
+import concurrent.futures
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+# default options for each tool, can be overridden with the "tools" config key
+DEFAULT_TOOL_OPTIONS = {
+    'calculator': {'timeout': 5, 'process': True},
+    'load_url': {'timeout': 60},
+    'web_search': {'timeout': 120, 'max_concurrency': 2},
+}
+DEFAULT_TIMEOUT = 30
+
+class _Worker:
+    def __init__(self, pid: int, conn: Connection):
+        self.pid = pid
+        self.conn = conn
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.conn.close()
+
+class ToolExecutor:
+    """
+    Runs tools in worker pools with per-tool timeouts and concurrency limits.
+
+    Tools run in a thread pool, except tools with the "process" option,
+    which run in worker processes so that a CPU-heavy call can be killed.
+    Async tools run on the provided event loop.
+
+    Forking a process with running threads can deadlock the child, so the worker processes are forked
+    by a single-threaded helper process instead of the bot. Call start before any threads are started,
+    until then process tools run in the thread pool.
+
+    Tool options:
+        timeout: seconds to wait for the result, including time spent waiting for a free slot
+        max_concurrency: maximum number of calls of the tool running at the same time (default: unlimited)
+        process: run the tool in a worker process
+    """
+    def __init__(self, threads: int = 4, processes: int = 1, tools: Optional[dict[str, dict]] = None):
+        self.threads = ThreadPoolExecutor(threads, thread_name_prefix='tool')
+        self.processes = processes
+        self.tool_options = {k: v.copy() for k, v in DEFAULT_TOOL_OPTIONS.items()}
+        for name, options in (tools or {}).items():
+            self.tool_options.setdefault(name, {}).update(options)
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+        # fork is the only start method that doesn't re-run the bot's main module in the worker
+        self._mp_context = None
+        if processes > 0 and 'fork' in multiprocessing.get_all_start_methods():
+            self._mp_context = multiprocessing.get_context('fork')
+        self._zygote: Optional[multiprocessing.Process] = None
+        self._zygote_conn: Optional[Connection] = None
+        self._zygote_lock = threading.Lock()
+        self._idle: queue.Queue[_Worker] = queue.Queue()
+        self._workers: set[_Worker] = set()
+
+    @property
+    def started(self) -> bool:
+        return self._zygote is not None
+
+    def start(self):
+        """Forks the process that creates the worker processes and starts the workers, does nothing if already started"""
+        with self._lock:
+            if self._mp_context is None or self._zygote is not None:
+                return
+            conn, child_conn = multiprocessing.Pipe()
+            self._zygote = self._mp_context.Process(target=_zygote_main, args=(child_conn,), name='tool-zygote', daemon=True)
+            self._zygote.start()
+            child_conn.close()
+            self._zygote_conn = conn
+        for _ in range(self.processes):
+            self._idle.put(self._spawn_worker())
+
+    def options(self, name: str) -> dict:
+        options = {'timeout': DEFAULT_TIMEOUT, 'max_concurrency': None, 'process': False}
+        options.update(self.tool_options.get(name, {}))
+        return options
+
+    def run(self, name: str, target: Callable, args: tuple, kwargs: dict,
+            loop: Optional[asyncio.AbstractEventLoop] = None, cancel: Optional[threading.Event] = None):
+        """
+        Run a tool and wait for its result.
+
+        Args:
+            name: Name of the tool, used to look up its options
+            target: The tool function
+            args, kwargs: Arguments to call the tool with
+            loop: The running event loop to execute async tools in.
+                  If not provided, the tool runs in a new event loop in the thread pool.
+            cancel: Event that aborts the call when set
+
+        Returns:
+            Return value of the tool
+
+        Raises:
+            TimeoutError: Tool didn't finish in time
+            concurrent.futures.CancelledError: cancel was set
+        """
+        options = self.options(name)
+        timeout = options['timeout']
+        deadline = time.monotonic() + timeout
+
+        semaphore = self._semaphore(name, options['max_concurrency'])
+        if semaphore is not None:
+            if not semaphore.acquire(timeout=timeout):
+                raise TimeoutError(f"Tool {name} is busy, try again later")
+        use_process = options['process'] and self.started and not inspect.iscoroutinefunction(target)
+        if use_process:
+            try:
+                return self._run_in_process(name, target, args, kwargs, timeout, deadline, cancel)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+        try:
+            future = self._submit(target, args, kwargs, loop)
+        except:
+            if semaphore is not None:
+                semaphore.release()
+            raise
+        if semaphore is not None:
+            # release when the work actually stops, not when we stop waiting for it
+            future.add_done_callback(lambda _: semaphore.release())
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # running threads can't be stopped, the result will be discarded
+                future.cancel()
+                raise TimeoutError(f"Tool {name} timed out after {timeout} seconds")
+            done, _ = concurrent.futures.wait([future], timeout=min(remaining, 0.1))
+            if done:
+                return future.result()
+            if cancel is not None and cancel.is_set():
+                future.cancel()
+                raise concurrent.futures.CancelledError(f"Tool {name} was cancelled")
+
+    def shutdown(self):
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            workers, self._workers = self._workers, set()
+            zygote, self._zygote = self._zygote, None
+        for worker in workers:
+            worker.kill()
+        if zygote is not None:
+            self._zygote_conn.close()
+            zygote.terminate()
+
+    def _submit(self, target: Callable, args: tuple, kwargs: dict, loop: Optional[asyncio.AbstractEventLoop]) -> Future:
+        if inspect.iscoroutinefunction(target):
+            if loop is not None and loop.is_running():
+                return asyncio.run_coroutine_threadsafe(target(*args, **kwargs), loop)
+            return self.threads.submit(asyncio.run, target(*args, **kwargs))
+        return self.threads.submit(target, *args, **kwargs)
+
+    def _run_in_process(self, name: str, target: Callable, args: tuple, kwargs: dict,
+                        timeout: float, deadline: float, cancel: Optional[threading.Event]):
+        try:
+            worker = self._idle.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            raise TimeoutError(f"Tool {name} is busy, try again later") from None
+        try:
+            worker.conn.send((target, args, kwargs))
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Tool {name} timed out after {timeout} seconds")
+                if cancel is not None and cancel.is_set():
+                    raise concurrent.futures.CancelledError(f"Tool {name} was cancelled")
+                if worker.conn.poll(min(remaining, 0.1)):
+                    ok, result = worker.conn.recv()
+                    break
+        except (TimeoutError, concurrent.futures.CancelledError):
+            # a running process can't be interrupted, kill it and replace it with a new one
+            self._replace_worker(worker)
+            raise
+        except (EOFError, OSError):
+            self._replace_worker(worker)
+            raise RuntimeError(f"Worker process running {name} exited unexpectedly") from None
+        except BaseException:
+            self._replace_worker(worker)
+            raise
+        self._idle.put(worker)
+        if not ok:
+            raise result
+        return result
+
+    def _spawn_worker(self) -> _Worker:
+        conn, child_conn = multiprocessing.Pipe()
+        with self._zygote_lock:
+            reduction.send_handle(self._zygote_conn, child_conn.fileno(), None)
+            pid = self._zygote_conn.recv()
+        child_conn.close()
+        worker = _Worker(pid, conn)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace_worker(self, worker: _Worker):
+        worker.kill()
+        with self._lock:
+            self._workers.discard(worker)
+            if self._zygote is None:
+                # shut down
+                return
+        self._idle.put(self._spawn_worker())
+
+    def _semaphore(self, name: str, max_concurrency: Optional[int]) -> Optional[threading.BoundedSemaphore]:
+        if not max_concurrency:
+            return None
+        with self._lock:
+            if name not in self._semaphores:
+                self._semaphores[name] = threading.BoundedSemaphore(max_concurrency)
+            return self._semaphores[name]
+
+def _zygote_main(conn: Connection):
+    """Forks a worker process for every connection received, runs single-threaded so forking is safe"""
+    # workers are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        try:
+            fd = reduction.recv_handle(conn)
+        except (EOFError, OSError):
+            return
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                conn.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _worker_main(Connection(fd))
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(fd)
+        conn.send(pid)
+
+def _worker_main(conn: Connection):
+    while True:
+        try:
+            target, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        except Exception as e:
+            conn.send((False, e))
+            continue
+        try:
+            result = (True, target(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # result or exception can't be pickled
+            conn.send((False, RuntimeError(f"{type(e).__name__}: {e}")))
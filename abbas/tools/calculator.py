@@ -1,6 +1,8 @@
 import ast
 import math
 import operator
+from functools import lru_cache
+from typing import Callable
 
 MAX_POW = 128
 
@@ -16,109 +18,134 @@ def _get_max_factorial():
     return i-1
 MAX_FACTORIAL = _get_max_factorial()
 
+_functions = {x: getattr(math, x) for x in dir(math) if not x.startswith('_')}
+_functions['abs'] = abs
+
+_allowed_nodes = {
+    ast.Expression,
+    ast.BinOp,
+    # literals
+    ast.Constant,
+    # unary operations
+    ast.UnaryOp,
+    ast.UAdd,
+    ast.USub,
+    ast.Invert,
+    # math operators
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    # binary operators
+    ast.LShift,
+    ast.RShift,
+    ast.BitOr,
+    ast.BitXor,
+    ast.BitAnd,
+    # comparisions
+    ast.Compare,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    # functions
+    ast.Call,
+    ast.Name,
+    ast.Load,
+}
+
+_ops = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Invert: operator.invert,
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.BitAnd: operator.and_,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge
+}
+
 def calculator(query: str):
     """A simple calculator. Supports math functions like "sqrt", "cos", etc. Use every time the user asks a math question."""
     if not query:
         return None
     if not isinstance(query, str):
         raise TypeError("Query must be str")
-    locals = {x for x in dir(math) if not x.startswith('_')}
-    locals = {x: getattr(math, x) for x in locals}
-    locals['abs'] = abs
+    evaluate = _compile(query)
+    
+    try:
+        result = evaluate()
+    except (ZeroDivisionError, OverflowError):
+        result = math.inf
+    return result
+
+@lru_cache(maxsize=256)
+def _compile(query: str) -> Callable:
+    """Validates the query and compiles it to a closure that evaluates it"""
     tree = ast.parse(query, mode='eval')
+    _validate(tree)
+    return _compile_node(tree)
+
+def _validate(node: ast.AST):
+    if type(node) not in _allowed_nodes:
+        raise ValueError(f"Disallowed operation: {type(node).__name__}")
     
-    allowed_nodes = {
-        ast.Expression,
-        ast.BinOp,
-        # literals
-        ast.Constant,
-        # unary operations
-        ast.UnaryOp,
-        ast.UAdd,
-        ast.USub,
-        ast.Invert,
-        # math operators
-        ast.Add,
-        ast.Sub,
-        ast.Mult,
-        ast.Div,
-        ast.FloorDiv,
-        ast.Mod,
-        ast.Pow,
-        # binary operators
-        ast.LShift,
-        ast.RShift,
-        ast.BitOr,
-        ast.BitXor,
-        ast.BitAnd,
-        # comparisions
-        ast.Compare,
-        ast.Eq,
-        ast.NotEq,
-        ast.Lt,
-        ast.LtE,
-        ast.Gt,
-        ast.GtE,
-        # functions
-        ast.Call,
-        ast.Name,
-        ast.Load,
-    }
-
-    ops = {
-        ast.UAdd: operator.pos,
-        ast.USub: operator.neg,
-        ast.Invert: operator.invert,
-        ast.Add: operator.add,
-        ast.Sub: operator.sub,
-        ast.Mult: operator.mul,
-        ast.Div: operator.truediv,
-        ast.FloorDiv: operator.floordiv,
-        ast.Mod: operator.mod,
-        ast.Pow: operator.pow,
-        ast.LShift: operator.lshift,
-        ast.RShift: operator.rshift,
-        ast.BitOr: operator.or_,
-        ast.BitXor: operator.xor,
-        ast.BitAnd: operator.and_,
-        ast.Compare: operator.eq,
-        ast.NotEq: operator.ne,
-        ast.Lt: operator.lt,
-        ast.LtE: operator.le,
-        ast.Gt: operator.gt,
-        ast.GtE: operator.ge
-    }
-
-    def _validate(node):
-        if type(node) not in allowed_nodes:
-            raise ValueError(f"Disallowed operation: {type(node).__name__}")
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name):
+            raise ValueError(f"Disallowed func type: {type(node.func).__name__}")
+    if isinstance(node, ast.Name):
+        if node.id not in _functions:
+            raise ValueError(f"Disallowed function: {node.id}")
+    if isinstance(node, ast.Constant):
+        if not isinstance(node.value, (int, float, bool)):
+            raise ValueError(f"Disallowed value: {node.value}")
+
+    for child in ast.iter_child_nodes(node):
+        _validate(child)
+
+def _check(result):
+    if abs(result) > MAX_VALUE:
+        raise OverflowError
+    return result
+
+def _compile_node(node: ast.AST) -> Callable:
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda: _check(value)
+    elif isinstance(node, ast.Name):
+        value = _functions[node.id]
+        return lambda: _check(value)
+    elif isinstance(node, ast.Expression):
+        body = _compile_node(node.body)
+        return lambda: _check(body())
+    elif isinstance(node, ast.Call):
+        target = node.func.id
+        function = _functions[target]
+        args_ = tuple(_compile_node(x) for x in node.args)
+        kwargs_ = tuple((x.arg, _compile_node(x.value)) for x in node.keywords)
         
-        if isinstance(node, ast.Call):
-            if not isinstance(node.func, ast.Name):
-                raise ValueError(f"Disallowed func type: {type(node.func).__name__}")
-        if isinstance(node, ast.Name):
-            if node.id not in locals:
-                raise ValueError(f"Disallowed function: {node.id}")
-        if isinstance(node, ast.Constant):
-            if not isinstance(node.value, (int, float, bool)):
-                raise ValueError(f"Disallowed value: {node.value}")
-
-        for child in ast.iter_child_nodes(node):
-            _validate(child)
-    _validate(tree)
+        def _call():
+            args = tuple(x() for x in args_)
+            kwargs = {k: v() for k, v in kwargs_}
 
-    def _evaluate(node):
-        if isinstance(node, ast.Constant):
-            result = node.value
-        elif isinstance(node, ast.Name):
-            result = locals[node.id]
-        elif isinstance(node, ast.Expression):
-            result = _evaluate(node.body)
-        elif isinstance(node, ast.Call):
-            target = node.func.id
-            args = tuple(_evaluate(x) for x in node.args)
-            kwargs = {x.arg: _evaluate(x.value) for x in node.keywords}
-            
             if target == 'factorial':
                 if args[0] > MAX_FACTORIAL:
                     raise OverflowError
@@ -130,42 +157,48 @@ def calculator(query: str):
                         return 0
                     if any(x > MAX_FACTORIAL for x in args):
                         raise OverflowError
-
-            globals = {'__builtins__': None}
-            locals_ = locals.copy()
-            locals_.update({'target': locals[target], 'args': args, 'kwargs': kwargs})
             
-            # call in sandbox
-            result = eval("target(*args, **kwargs)", globals, locals_)
-        elif isinstance(node, ast.UnaryOp):
-            operator = ops[type(node.op)]
-            operand = _evaluate(node.operand)
-            result = operator(operand)
-        elif isinstance(node, ast.BinOp):
-            operator = ops[type(node.op)]
-            left = _evaluate(node.left)
-            right = _evaluate(node.right)
-
-            if isinstance(node.op, ast.Pow):
+            return _check(function(*args, **kwargs))
+        return _call
+    elif isinstance(node, ast.UnaryOp):
+        op = _ops[type(node.op)]
+        operand = _compile_node(node.operand)
+        return lambda: _check(op(operand()))
+    elif isinstance(node, ast.BinOp):
+        op = _ops[type(node.op)]
+        left_ = _compile_node(node.left)
+        right_ = _compile_node(node.right)
+        is_pow = isinstance(node.op, ast.Pow)
+        is_lshift = isinstance(node.op, ast.LShift)
+
+        def _binop():
+            left = left_()
+            right = right_()
+
+            if is_pow:
                 if abs(left) > MAX_POW or abs(right) > MAX_POW:
                     raise OverflowError
-            if isinstance(node.op, ast.LShift):
+            if is_lshift:
                 if right > MAX_LSHIFT:
                     raise OverflowError
 
-            result = operator(left, right)
-        else:
-            raise ValueError(f"Invalid ast node? {type(node).__name__}")
-        
-        if abs(result) > MAX_VALUE:
-            raise OverflowError
-        return result
-    
-    try:
-        result = _evaluate(tree)
-    except (ZeroDivisionError, OverflowError):
-        result = math.inf
-    return result
+            return _check(op(left, right))
+        return _binop
+    elif isinstance(node, ast.Compare):
+        left_ = _compile_node(node.left)
+        comparators = tuple((_ops[type(op)], _compile_node(x)) for op, x in zip(node.ops, node.comparators))
+
+        def _compare():
+            left = left_()
+            for op, right_ in comparators:
+                right = right_()
+                if not op(left, right):
+                    return False
+                left = right
+            return True
+        return _compare
+    else:
+        raise ValueError(f"Invalid ast node? {type(node).__name__}")
 
 if __name__ == "__main__":
     while True:
@@ -1,13 +1,18 @@
 import os
 import json
+import time
+import heapq
 import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urlunparse
 import httpx
 import replicate
-from bs4 import BeautifulSoup, Tag
-from typing import Optional, Callable
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from typing import Optional, Callable, Iterator
 
 user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36"
+max_download_size = 2 * 1024 * 1024 # bytes, the rest of the page is never downloaded
 
 def load_url(url: str, question: Optional[str] = None) -> str:
     """Answers question about content of a website. Use every time the user's message contains a link."""
@@ -61,62 +66,160 @@ def _rewrite_url(url: str) -> str:
 def _fetch(url: str) -> str:
     if url.startswith("youtube://"):
         return _fetch_youtube(url)
-    r = httpx.get(url, headers={'user-agent': user_agent, 'accept-language': 'en;q=0.9,*;q=0.5'}, follow_redirects=True)
-    _raise_for_status(r)
-    soup = BeautifulSoup(r.text, 'lxml')
+    with httpx.stream("GET", url, headers={'user-agent': user_agent, 'accept-language': 'en;q=0.9,*;q=0.5'}, follow_redirects=True) as r:
+        _raise_for_status(r)
+        content = _read_capped(r, max_download_size)
+        encoding = r.charset_encoding
     parser = _get_parser(url)
-    text = parser(soup)
-    return text
+    if parser in _strainers:
+        strainer, roots = _strainers[parser]
+        soup = BeautifulSoup(content, 'lxml', parse_only=strainer, from_encoding=encoding)
+        # if the page layout doesn't match the strainer, parse the whole document instead
+        if all(soup.find(**root) for root in roots):
+            return parser(soup)
+    return parser(BeautifulSoup(content, 'lxml', from_encoding=encoding))
+
+def _read_capped(response: httpx.Response, limit: int) -> bytes:
+    chunks = []
+    size = 0
+    for chunk in response.iter_bytes():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+    return b''.join(chunks)[:limit]
 
 def _fetch_youtube(url: str) -> str:
-    key = os.getenv("GOOGLE_APIKEY")
     path = url.split('/')[2:]
     if path[0] == 'watch':
-        url = "https://www.googleapis.com/youtube/v3/videos"
-        r = httpx.get(url, params={'part': 'snippet', 'id': path[1], 'maxResults': 1, 'key': key})
-        _raise_for_status(r)
-        response = json.loads(r.text)
-        video = response['items'][0]['snippet']
+        video = _youtube_videos([path[1]])[path[1]]
         title = video['title']
         description = video['description']
         author = video['channelTitle']
         return f"YouTube video\n\nTitle: {title}\nAuthor: {author}\nDescription:\n{description.replace('\n\n', '\n')}"[:8000]
     else:
-        data = {'part': 'snippet,statistics,contentDetails', 'maxResults': 1, 'key': key}
         match path[0]:
             case 'channel':
-                data['id'] = path[1]
+                field = 'id'
             case 'user':
-                data['forUsername'] = path[1]
+                field = 'forUsername'
             case 'handle':
-                data['forHandle'] = path[1]
+                field = 'forHandle'
             case _:
                 raise ValueError("Incorrect youtube path: " + path[0]) # should never happen
-        url = "https://www.googleapis.com/youtube/v3/channels"
-        r = httpx.get(url, params=data)
-        _raise_for_status(r)
-        response = json.loads(r.text)
-
-        channel = response['items'][0]['snippet']
-        channel.update(response['items'][0]['statistics'])
+        if field == 'id' and path[1].startswith('UC'):
+            # uploads playlist id can be derived from channel id, fetch both at once
+            channel_future = _youtube_pool.submit(_youtube_channel, field, path[1])
+            uploads = _youtube_uploads('UU' + path[1][2:])
+            channel = channel_future.result()
+        else:
+            channel = _youtube_channel(field, path[1])
+            uploads = _youtube_uploads(channel['uploads'])
         title = channel['title']
         description = channel['description']
         subscribers = channel['subscriberCount']
-        uploads = response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
 
-        url = "https://www.googleapis.com/youtube/v3/playlistItems"
-        r = httpx.get(url, params={'part': 'snippet', 'playlistId': uploads, 'maxResults': 5, 'key': key})
-        _raise_for_status(r)
-        response = json.loads(r.text)
-        uploads = response['items']
         if len(uploads) == 0:
             uploads_text = "This channel has no videos."
         else:
             uploads_text = f"Last {len(uploads)} videos (latest to oldest):\n"
-            uploads_text += "\n".join(x['snippet']['title'] for x in uploads)
+            uploads_text += "\n".join(uploads)
         
         return f"YouTube channel\n\nTitle: {title}\nSubscriber count: {subscribers}\nDescription:\n{description.replace('\n\n', '\n')}\n\n{uploads_text}"[:8000]
 
+def prefetch_youtube(urls: list[str]):
+    """Fetches metadata of all YouTube videos in urls with a single API request and caches it"""
+    ids = []
+    for url in urls:
+        try:
+            url = _rewrite_url(url)
+        except (KeyError, ValueError, IndexError):
+            continue
+        if url.startswith("youtube://watch/"):
+            ids.append(url.split('/')[3])
+    if ids:
+        _youtube_videos(ids)
+
+class _TTLCache:
+    def __init__(self, ttl: float, max_size: int = 256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            expires, value = self._data[key]
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.max_size:
+                now = time.monotonic()
+                self._data = {k: v for k, v in self._data.items() if v[0] >= now}
+                while len(self._data) >= self.max_size:
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+_youtube_api = httpx.Client(base_url="https://www.googleapis.com/youtube/v3/", timeout=10)
+_youtube_pool = ThreadPoolExecutor(4, thread_name_prefix='youtube')
+_youtube_video_cache = _TTLCache(600)
+_youtube_channel_cache = _TTLCache(600)
+_youtube_uploads_cache = _TTLCache(300)
+
+def _youtube_get(endpoint: str, params: dict) -> dict:
+    params['key'] = os.getenv("GOOGLE_APIKEY")
+    r = _youtube_api.get(endpoint, params=params)
+    _raise_for_status(r)
+    return json.loads(r.text)
+
+def _youtube_videos(ids: list[str]) -> dict[str, dict]:
+    """Returns snippets of the videos, fetching all uncached ones in one request"""
+    videos = {}
+    missing = []
+    for id in ids:
+        video = _youtube_video_cache.get(id)
+        if video is None:
+            missing.append(id)
+        else:
+            videos[id] = video
+    for i in range(0, len(missing), 50): # API limit of ids per request
+        batch = missing[i:i+50]
+        response = _youtube_get("videos", {'part': 'snippet', 'id': ','.join(batch), 'maxResults': len(batch)})
+        for item in response['items']:
+            _youtube_video_cache.set(item['id'], item['snippet'])
+            videos[item['id']] = item['snippet']
+    for id in ids:
+        if id not in videos:
+            raise ValueError(f"YouTube video not found: {id}")
+    return videos
+
+def _youtube_channel(field: str, value: str) -> dict:
+    channel = _youtube_channel_cache.get((field, value))
+    if channel is not None:
+        return channel
+    response = _youtube_get("channels", {'part': 'snippet,statistics,contentDetails', 'maxResults': 1, field: value})
+    channel = response['items'][0]['snippet']
+    channel.update(response['items'][0]['statistics'])
+    channel['uploads'] = response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
+    _youtube_channel_cache.set((field, value), channel)
+    return channel
+
+def _youtube_uploads(playlist_id: str) -> list[str]:
+    """Returns titles of the last 5 videos in an uploads playlist"""
+    uploads = _youtube_uploads_cache.get(playlist_id)
+    if uploads is not None:
+        return uploads
+    response = _youtube_get("playlistItems", {'part': 'snippet', 'playlistId': playlist_id, 'maxResults': 5})
+    uploads = [x['snippet']['title'] for x in response['items']]
+    _youtube_uploads_cache.set(playlist_id, uploads)
+    return uploads
+
 def _get_parser(url: str) -> Callable:
     domain = urlparse(url).netloc.split('.')
     if domain[-3:] == ['old', 'reddit', 'com']:
@@ -125,14 +228,22 @@ def _get_parser(url: str) -> Callable:
         return _parser_wikipedia
     return _parser_default
 
-def _parser_default(soup: BeautifulSoup):
+def _parser_default(soup: BeautifulSoup, max_length = 8000):
     main = soup.find_all("main") or soup.find_all(role="main")
     for x in soup.find_all("article"):
         if not set(main) & set(x.parents):
             main.append(x)
     if not main:
         main = [soup]
-    text = "\n\n".join(x.get_text("\n", strip=True) for x in main)
+    texts = []
+    length = 0
+    for x in main:
+        texts.append(x.get_text("\n", strip=True))
+        length += len(texts[-1]) + 2
+        if length > max_length:
+            # already too long, the rest would be thrown away anyway
+            break
+    text = "\n\n".join(texts)
     return text
 
 def _parser_reddit(soup: BeautifulSoup, max_length = 8000):
@@ -207,17 +318,33 @@ def _parser_reddit(soup: BeautifulSoup, max_length = 8000):
     
     # remove least important comments (lowest rated, without children) to get under the character limit
     template_len = len('<comment author="">\n\n</comment>\n')
-    while len(text) + template_len * len(comments) + len(''.join(comment['author'] + comment['text'] for comment in comments)) > max_length:
-        parents = {x['parent'] for x in comments}
-        childless = (x for x in comments if x['id'] not in parents)
-        worst = min(childless, key=lambda x: x['score'])
-        comments.remove(worst)
+    total = len(text) + sum(template_len + len(x['author']) + len(x['text']) for x in comments)
+    by_id = {x['id']: x for x in comments}
+    children = {x['id']: {} for x in comments}
+    children[0] = {}
+    for x in comments:
+        children[x['parent']][x['id']] = x
+    # (score, id) keeps the same tie-breaking as picking the first lowest comment in thread order
+    childless = [(x['score'], x['id']) for x in comments if not children[x['id']]]
+    heapq.heapify(childless)
+    while total > max_length and childless:
+        _, worst_id = heapq.heappop(childless)
+        worst = by_id[worst_id]
+        total -= template_len + len(worst['author']) + len(worst['text'])
+        parent_id = worst['parent']
+        siblings = children[parent_id]
+        del siblings[worst_id]
+        if parent_id and not siblings:
+            parent = by_id[parent_id]
+            heapq.heappush(childless, (parent['score'], parent_id))
+    if total > max_length:
+        raise ValueError("Not enough space to fit comments")
 
     def serialize_comments(parent_id = 0):
-        return ''.join(serialize_comment(comment) for comment in filter(lambda x: x['parent']==parent_id, comments))
+        return ''.join(serialize_comment(comment) for comment in children[parent_id].values())
     def serialize_comment(comment):
-        children = serialize_comments(comment['id'])
-        return f"<comment author=\"{comment['author']}\">\n{comment['text']}\n{children}</comment>\n"
+        children_text = serialize_comments(comment['id'])
+        return f"<comment author=\"{comment['author']}\">\n{comment['text']}\n{children_text}</comment>\n"
     
     text += serialize_comments()
     return text
@@ -227,13 +354,32 @@ def _parser_wikipedia(soup: BeautifulSoup, max_length = 8000):
     sitesub = soup.find(id="siteSub").text.strip()
     content = soup.find(id="mw-content-text").find(class_="mw-parser-output")
 
-    sections = {}
+    sections = _wikipedia_sections(content)
+    _, intro = next(sections, ('_', ''))
+    text = f"{title}\n{sitesub}\n\n{intro}"
+    
+    if len(text) > max_length:
+        # raise error if we can't even insert the introduction
+        raise ValueError("Wikipedia article is too long to summarize!")
+    
+    for k, v in sections:
+        if not v:
+            continue
+        subtext = f"\n\n{k}\n\n{v}"
+        if len(text + subtext) > max_length:
+            break
+        text += subtext
+    
+    return text
+
+def _wikipedia_sections(content: Tag) -> Iterator[tuple[str, str]]:
+    """Yields (heading, text) of each article section lazily, starting with the introduction ('_')"""
     para = ['_']
 
     for elem in content.children:
         if elem.name == 'div' and elem.has_attr('class') and 'mw-heading2' in elem['class']:
             text = '\n'.join(para[1:])
-            sections[para[0]] = text.strip()
+            yield para[0], text.strip()
             para = [elem.find('h2').text.strip()]
             continue
         if elem.name == 'p':
@@ -241,21 +387,19 @@ def _parser_wikipedia(soup: BeautifulSoup, max_length = 8000):
                 sup.decompose()
             para.append(elem.text.strip())
             continue
-    
-    sections = {k: v for k, v in sections.items() if v}
-    text = f"{title}\n{sitesub}\n\n{sections.pop('_')}"
-    
-    if len(text) > max_length:
-        # raise error if we can't even insert the introduction
-        raise ValueError("Wikipedia article is too long to summarize!")
-    
-    for k, v in sections.items():
-        subtext = f"\n\n{k}\n\n{v}"
-        if len(text + subtext) > max_length:
-            break
-        text += subtext
-    
-    return text
+    yield para[0], '\n'.join(para[1:]).strip()
+
+# only build the part of the document that the parser reads, (strainer, elements the parser needs)
+_strainers = {
+    _parser_reddit: (
+        SoupStrainer("div", attrs={"role": "main"}),
+        [{'name': "p", 'class_': "title"}, {'name': "p", 'class_': "tagline"}, {'class_': "commentarea"}]
+    ),
+    _parser_wikipedia: (
+        SoupStrainer(id="content"),
+        [{'class_': "mw-page-title-main"}, {'id': "siteSub"}, {'id': "mw-content-text"}]
+    ),
+}
 
 def _answer_question(text: str, question: str) -> str:
     system_prompt = "The user provides a question and a website's text. You analyze the text and answer the question."
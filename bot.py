@@ -1,5 +1,7 @@
 import os
 import re
+import time
+import asyncio
 import contextlib
 from urllib.parse import urlparse
 import discord
@@ -7,7 +9,7 @@ import discord.app_commands
 import abbas
 import replicate.exceptions
 from traceback import print_exc
-from typing import Optional
+from typing import Awaitable, Callable, Optional, Sequence
 
 Message = abbas.Message
 
@@ -19,36 +21,149 @@ intents.message_content = True
 
 cache: dict[int, Message] = {}
 last_message: dict[int, int] = {}
+background_tasks: set[asyncio.Task] = set()
+# task responding to the latest burst of mentions from a user in a channel, by (channel id, user id)
+bursts: dict[tuple[int, int], asyncio.Task] = {}
+max_burst_length = 10
+# messages each response task answers, in the order they were sent
+responding: dict[asyncio.Task, list[discord.Message]] = {}
+# tasks responding to a message, by ids of the messages they answer
+in_flight: dict[int, asyncio.Task] = {}
 
 class Abbas(discord.Client):
     def __init__(self, *, intents: discord.Intents, **options) -> None:
         super().__init__(intents=intents, **options)
         self.config = abbas.Config('config.json')
         self.name = self.config.name or "Abbas Baszir"
-        self.images = abbas.ImagesManager(
+        # set when their components finish initializing, see wait_for_components
+        self.images: abbas.ImagesManager = None
+        self.mysql: abbas.MySQL = None
+        self.responder: abbas.LlamaResponder = None
+        self.scheduler = abbas.Scheduler(self.config.max_concurrent_responses or 4)
+        self.tool_executor = abbas.ToolExecutor(
+            self.config.tool_threads or 4,
+            self.config.tool_processes if self.config.tool_processes is not None else 1,
+            self.config.tools or {}
+        )
+        # the worker processes are forked while the bot has no other threads yet
+        self.tool_executor.start()
+        self._components: dict[str, asyncio.Task] = {}
+        self._started = time.monotonic()
+        self._ready_once = False
+
+    async def setup_hook(self):
+        # components load at the same time, while the client connects to Discord
+        self._components = {
+            'images': asyncio.create_task(self._init_component('images', self._create_images)),
+            'mysql': asyncio.create_task(self._init_component('mysql', self._create_mysql)),
+            'responder': asyncio.create_task(self._init_component('responder', self._create_responder)),
+            'commands': asyncio.create_task(self._init_component('commands', self._sync_commands)),
+        }
+        if self.config.warm_up_conversations != 0:
+            self._components['warm_up'] = asyncio.create_task(self._init_component('warm_up', self._warm_up_cache))
+
+    async def wait_for_components(self, *names: str):
+        """Waits until the components are initialized"""
+        await asyncio.gather(*(asyncio.shield(self._components[name]) for name in names))
+
+    def component_ready(self, name: str) -> bool:
+        task = self._components.get(name)
+        return task is not None and task.done() and not task.cancelled() and task.exception() is None
+
+    async def _init_component(self, name: str, init: Callable[[], Awaitable]):
+        started = time.monotonic()
+        try:
+            await init()
+        except Exception:
+            print(f"ERROR: Failed to initialize {name}")
+            print_exc()
+            await self.close()
+            raise
+        print(f"Initialized {name} in {time.monotonic() - started:.2f}s ({time.monotonic() - self._started:.2f}s since start)")
+
+    async def _create_images(self):
+        # local BLIP and OCR models load for a while, keep the event loop running meanwhile
+        self.images = await asyncio.to_thread(
+            abbas.ImagesManager,
             self.config.clip_source or 'replicate',
             self.config.clip_timeout or 10,
             self.config.clip_max_size or 512,
             self.config.ocr or False,
-            tenor_apikey
+            tenor_apikey,
+            precaption_budget=self.config.precaption_budget or 60
         )
-        self.mysql = abbas.MySQL(**self.config.mysql)
-        self.responder = abbas.ReplicateLlamaResponder(
+
+    async def _create_mysql(self):
+        mysql = abbas.MySQL(**self.config.mysql)
+        await mysql.connect()
+        self.mysql = mysql
+
+    async def _create_responder(self):
+        backend = self.config.backend or 'replicate'
+        if backend == 'local':
+            responder = abbas.LocalLlamaResponder
+            options = {'url': self.config.local_url or 'http://127.0.0.1:8080', 'model': self.config.local_model}
+        elif backend == 'replicate':
+            responder = abbas.ReplicateLlamaResponder
+            options = {}
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+        responder = await asyncio.to_thread(
+            responder,
             self.config.context_length or 2000,
-            self.config.heating or False
+            self.config.heating or False,
+            tool_executor=self.tool_executor,
+            caller=abbas.ResilientCaller(
+                timeout=self.config.llm_timeout or 60,
+                retries=self.config.llm_retries if self.config.llm_retries is not None else 2,
+                hedge_percentile=self.config.llm_hedge_percentile,
+                failure_threshold=self.config.llm_circuit_threshold or 5,
+                reset_timeout=self.config.llm_circuit_reset or 30,
+                retryable=responder.is_retryable
+            ),
+            **options
         )
+        await responder.warm_up()
+        self.responder = responder
+
+    async def _sync_commands(self):
+        try:
+            await tree.sync()
+        except Exception:
+            # only the slash commands are missing, the bot still answers mentions
+            print("WARNING: Failed to sync the application commands")
+            print_exc()
+
+    async def _warm_up_cache(self):
+        # recent conversations are loaded up front, so the first replies after a restart don't wait for MySQL
+        await self.wait_for_components('mysql')
+        try:
+            messages, last_messages = await self.mysql.warm_up(
+                self.config.warm_up_conversations or 50,
+                (self.config.warm_up_max_age or 24) * 3600
+            )
+        except Exception:
+            # the cache fills up on demand as well, the bot works without it
+            print("WARNING: Failed to warm up the message cache")
+            print_exc()
+            return
+        for msg in messages:
+            cache.setdefault(msg.id, msg)
+        for channel_id, message_id in last_messages.items():
+            last_message.setdefault(channel_id, message_id)
+        print(f"Loaded {len(messages)} messages from {len(last_messages)} channels into the cache")
 
 client = Abbas(intents=intents)
 tree = discord.app_commands.CommandTree(client)
 
 @client.event
 async def on_ready():
-    try:
-        await client.mysql.connect()
-    except:
-        exit(1)
-    await tree.sync()
+    # on_ready fires again after every reconnect
     await client.change_presence(activity=discord.CustomActivity(name=client.config.custom_status))
+    if client._ready_once:
+        print(f"{client.name} reconnected as {client.user}")
+        return
+    client._ready_once = True
     print(f"{client.name} working as {client.user}")
 
 @client.event
@@ -56,6 +171,8 @@ async def on_message(message: discord.Message):
     if message.author == client.user:
         return
     if not client.user in message.mentions:
+        if client.config.precaptioning:
+            precaption(message)
         return
     print(f"@{message.author.display_name}: {message.clean_content}")
     if not message.reference and message.clean_content == f"@{message.mentions[0].display_name}":
@@ -64,56 +181,222 @@ async def on_message(message: discord.Message):
                 with open('first_message.txt', 'r', encoding='utf-8') as file:
                     text = file.read()
                 reply = await message.reply(text)
-                msg = Message(reply.id, None, 'assistant', text)
+                msg = Message(reply.id, None, 'assistant', text, channel=reply.channel.id)
+                await client.wait_for_components('mysql')
                 await client.mysql.insert_message(msg)
                 cache[reply.id] = msg
                 last_message[reply.channel.id] = reply.id
                 return
             except OSError:
                 pass
-    await respond(message)
+    earlier = []
+    burst = bursts.get((message.channel.id, message.author.id))
+    window = client.config.coalesce_window or 0
+    if (window > 0 and burst is not None and not burst.done()
+            and (message.created_at - responding[burst][-1].created_at).total_seconds() <= window):
+        # answer the whole burst at once instead of each message separately
+        burst.cancel()
+        earlier = responding[burst][-max_burst_length+1:]
+    await answer_burst([*earlier, message])
+
+async def answer_burst(messages: list[discord.Message]):
+    """Responds to the last message, with the earlier messages of the burst folded into it"""
+    message = messages[-1]
+    task = asyncio.create_task(respond(message, earlier=messages[:-1]))
+    bursts[(message.channel.id, message.author.id)] = task
+    responding[task] = messages
+    for x in messages:
+        in_flight[x.id] = task
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        print(f"Response to {message.author.display_name} was cancelled")
+    finally:
+        forget_response(task)
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    remaining = cancel_response(payload.message_id)
+    if remaining:
+        # keep answering the rest of the burst
+        await answer_burst(remaining)
+
+@client.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    for message_id in payload.message_ids:
+        cancel_response(message_id)
+
+@client.event
+async def on_message_edit(before: discord.Message, after: discord.Message):
+    # link embeds being added also trigger edits, only react to changed text
+    # the bot's own replies are edited while streaming
+    if before.content == after.content or after.author == client.user:
+        return
+    # cancel before clearing, so the old response doesn't store its captions after they're cleared
+    remaining = cancel_response(after.id, after)
+    stored = cache.get(after.id)
+    if stored is not None or client.user in after.mentions:
+        # captions were made for the old content
+        if stored is not None:
+            stored.preprocessed = None
+        await client.wait_for_components('mysql')
+        await client.mysql.clear_preprocessed(after.id)
+    if remaining:
+        await answer_burst(remaining)
+
+def forget_response(task: asyncio.Task):
+    """Stops tracking the response task, new messages of its burst and edits or deletes no longer cancel it"""
+    for key in [key for key, burst_task in bursts.items() if burst_task is task]:
+        del bursts[key]
+    responding.pop(task, None)
+    for message_id in [message_id for message_id, x in in_flight.items() if x is task]:
+        del in_flight[message_id]
+
+def cancel_response(message_id: int, edited: Optional[discord.Message] = None) -> list[discord.Message]:
+    """
+    Cancel the response to a deleted or edited message.
+
+    Args:
+        message_id: ID of the deleted or edited message
+        edited: New version of the message if it was edited
+    Returns:
+        The messages the response was answering, with the message updated or removed, to be answered again.
+        Empty if there was no response in progress or nothing is left to answer.
+    """
+    task = in_flight.get(message_id)
+    if task is None or task.done():
+        return []
+    print(f"Message {message_id} was {'edited' if edited else 'deleted'}, cancelling the response")
+    task.cancel()
+    messages = responding.get(task, [])
+    # the restarted response takes over, later edits and deletes cancel that one
+    forget_response(task)
+    messages = [edited if x.id == message_id else x for x in messages]
+    return [x for x in messages if x is not None]
+
+async def preprocess_message(message: discord.Message) -> str:
+    """Returns text of the message with images replaced by their captions"""
+    latest = message.clean_content
+    urls: list[str] = re.findall(r'(https?://\S+)', latest)
+    youtube_urls = [x for x in urls if is_youtube_url(x)]
+    if youtube_urls:
+        run_in_background(prefetch_youtube(youtube_urls))
+    for x in message.attachments:
+        if x.content_type.startswith("image"):
+            urls.append(x.url)
+    refreshed = None
+    for url in urls:
+        image_url = url
+        discord_authenticated_url = False
+        uridata = urlparse(url)
+        if 'discord' in uridata.hostname and (uridata.query == '' or uridata.path.endswith('.gif')):
+            if refreshed is None:
+                refreshed = await message.fetch() # refresh auth urls
+            for x in refreshed.embeds:
+                if x.type == 'image':
+                    image_url = x.thumbnail.url
+                    discord_authenticated_url = True
+                    break
+                else:
+                    print(x.to_dict())
+            if not discord_authenticated_url:
+                print("ERROR: Failed to fetch authenticated image from Discord. Skipping")
+                continue
+        await client.wait_for_components('images')
+        caption = await client.images.caption_image(image_url)
+        if caption is None:
+            continue
+        name = uridata.path.split('/')[-1]
+        img_text = f"![{caption}]({name})"
+        print(img_text)
+        if url in latest:
+            latest = latest.replace(url, img_text)
+        else:
+            latest += "\n" + img_text
+    return latest
+
+def precaption(message: discord.Message, max_age: float = 1800):
+    """Start captioning images of a message in a channel the bot recently replied in, they'll probably be asked about"""
+    if message.channel.id not in last_message or not client.component_ready('images'):
+        return
+    last_reply = discord.utils.snowflake_time(last_message[message.channel.id])
+    if (message.created_at - last_reply).total_seconds() > max_age:
+        return
+    for x in message.attachments:
+        if x.content_type and x.content_type.startswith("image"):
+            client.images.precaption(x.url)
+    for x in message.embeds:
+        url = embed_image_url(x)
+        if url:
+            client.images.precaption(url)
 
-async def respond(message: discord.Message, *, interaction: Optional[discord.Interaction] = None):
+def embed_image_url(embed: discord.Embed) -> Optional[str]:
+    """The URL preprocess_message captions for an image link, Discord links are captioned from their embed thumbnail"""
+    if embed.type not in ('image', 'gifv') or not embed.url:
+        return None
+    if 'discord' in (urlparse(embed.url).hostname or ''):
+        return embed.thumbnail.url
+    return embed.url
+
+def with_cached_captions(message: discord.Message) -> str:
+    """Text of a message with captions of its images appended, only those captioned already"""
+    text = message.clean_content
+    if not client.component_ready('images'):
+        return text
+    urls = [x.url for x in message.attachments if x.content_type and x.content_type.startswith("image")]
+    urls += [url for url in map(embed_image_url, message.embeds) if url]
+    for url in urls:
+        caption = client.images.cached_caption(url)
+        if caption is not None:
+            name = urlparse(url).path.split('/')[-1]
+            text += f"\n![{caption}]({name})"
+    return text
+
+async def preprocess_cached(message: discord.Message) -> str:
+    """preprocess_message, reusing the text from an earlier response to the same message"""
+    stored = cache.get(message.id)
+    if stored is not None and stored.preprocessed is not None:
+        return stored.preprocessed
+    return await preprocess_message(message)
+
+async def respond(message: discord.Message, *, interaction: Optional[discord.Interaction] = None, earlier: Sequence[discord.Message] = ()):
+    """
+    Generate and send a reply to the message.
+
+    Args:
+        interaction: Slash command or button interaction to answer instead of replying to the message
+        earlier: Earlier messages of the same burst, in the order they were sent
+    """
+    started = time.monotonic()
+    await client.wait_for_components('mysql', 'responder')
+    stream = StreamingReply(message, interaction, started) if client.config.streaming else None
     context = message.channel.typing() if interaction is None else contextlib.nullcontext()
-    async with context:
-        messages = await create_message_list(message)
+    # interactions have to be answered before Discord's deadline, they skip the queue
+    slot = client.scheduler.slot(message.channel.id, priority=interaction is not None)
+    async with context, slot as waited:
+        if waited:
+            print(f"Waited {waited:.2f}s for a free slot, {client.scheduler.queue_depth} requests still queued")
+        # new messages aren't stored yet, only interactions answer messages again
+        messages = await asyncio.shield(create_message_list(message, stored=interaction is not None))
         print(f"Conversation length for {message.author.display_name}: {len(messages)}")
-        latest = message.clean_content
-        urls: list[str] = re.findall(r'(https?://\S+)', latest)
-        for x in message.attachments:
-            if x.content_type.startswith("image"):
-                urls.append(x.url)
-        for url in urls:
-            image_url = url
-            discord_authenticated_url = False
-            uridata = urlparse(url)
-            if 'discord' in uridata.hostname and (uridata.query == '' or uridata.path.endswith('.gif')):
-                await message.fetch() # refresh auth urls
-                for x in message.embeds:
-                    if x.type == 'image':
-                        image_url = x.thumbnail.url
-                        discord_authenticated_url = True
-                        break
-                    else:
-                        print(x.to_dict())
-                if not discord_authenticated_url:
-                    print("ERROR: Failed to fetch authenticated image from Discord. Skipping")
-                    continue
-            caption = await client.images.caption_image(image_url)
-            if caption is None:
-                continue
-            name = uridata.path.split('/')[-1]
-            img_text = f"![{caption}]({name})"
-            print(img_text)
-            if url in latest:
-                latest = latest.replace(url, img_text)
-            else:
-                latest += "\n" + img_text
-        messages[0].text = latest
-        await client.mysql.insert_message(messages[0])
+        if earlier or messages[0].preprocessed is None:
+            # earlier messages of a burst are folded into the one being answered
+            texts = await asyncio.gather(*(preprocess_cached(x) for x in [*earlier, message]))
+            messages[0].preprocessed = texts[-1]
+            messages[0].text = "\n".join(texts)
+            await asyncio.shield(client.mysql.insert_message(messages[0]))
         cache[message.id] = messages[0]
         try:
-            response = await client.responder.generate_response(messages)
+            response = await client.responder.generate_response(messages, on_update=stream.update if stream else None)
+        except asyncio.CancelledError:
+            # superseded by a newer message, remove the partial reply
+            partial = await stream.abort() if stream else None
+            if partial is not None:
+                with contextlib.suppress(discord.HTTPException):
+                    await partial.delete()
+            raise
         except Exception as e:
             print_exc()
             print("Responding with exception embed")
@@ -128,17 +411,114 @@ async def respond(message: discord.Message, *, interaction: Optional[discord.Int
                     title="Wystąpił błąd",
                     description="Podczas odpowiadania wystąpił następujący błąd: " + e_type
                 )
-            if interaction is not None:
+            partial = await stream.abort() if stream else None
+            if partial is not None:
+                await partial.edit(content=None, embed=embed, view=ExceptView(message))
+            elif interaction is not None:
                 await interaction.followup.send(embed=embed, view=ExceptView(message))
             else:
                 await message.reply(embed=embed, view=ExceptView(message))
             return
     text: str = response[1]
     print(f"{client.name}: {text}")
-    if interaction is not None:
+    # the response is final, a message arriving now gets its own response instead of replacing this one
+    forget_response(asyncio.current_task())
+    # the reply is sent and stored even if the task gets cancelled meanwhile
+    await asyncio.shield(send_response(message, interaction, stream, messages, text, started))
+
+class StreamingReply:
+    """
+    Sends the reply as soon as the model generates visible text, then edits it as more text arrives.
+    Edits are sent at most every `interval` seconds to stay under Discord's rate limits.
+    """
+    def __init__(self, message: discord.Message, interaction: Optional[discord.Interaction], started: float, interval: float = 1.2):
+        self.message = message
+        self.interaction = interaction
+        self.started = started
+        self.interval = interval
+        self.reply: Optional[discord.Message | discord.WebhookMessage] = None
+        self.text = ''
+        self.shown = ''
+        self.done = False
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    async def update(self, text: str):
+        # hide tool calls, they get replaced by the text generated after the tool returns
+        text = text.split('<|', 1)[0]
+        if text.endswith('<'):
+            text = text[:-1]
+        text = text.rstrip()
+        if not text:
+            return
+        self._set(text)
+    
+    async def finish(self, text: str) -> discord.Message | discord.WebhookMessage:
+        """Shows the final text and returns the reply message"""
+        self.done = True
+        self._set(text)
+        try:
+            await self._task
+        except discord.HTTPException:
+            # sending or editing the reply failed earlier, try once more with the final text
+            print("WARNING: Failed to update the streamed reply")
+            print_exc()
+            if self.reply is None:
+                self.reply = await self._send(text)
+            else:
+                await self.reply.edit(content=text)
+        return self.reply
+    
+    async def abort(self) -> Optional[discord.Message | discord.WebhookMessage]:
+        """Stops editing and returns the reply message if it was already sent"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # the reply failed to send or update before, the caller only needs what was sent
+                print_exc()
+        return self.reply
+
+    def _set(self, text: str):
+        self.text = text
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def _send(self, text: str) -> discord.Message | discord.WebhookMessage:
+        if self.interaction is not None:
+            return await self.interaction.followup.send(text, wait=True)
+        return await self.message.reply(text)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            text = self.text
+            if text != self.shown:
+                if self.reply is None:
+                    self.reply = await self._send(text)
+                    print(f"Time to first visible token: {time.monotonic() - self.started:.2f}s")
+                else:
+                    await self.reply.edit(content=text)
+                self.shown = text
+            if self.done and self.shown == self.text:
+                return
+            await asyncio.sleep(self.interval)
+
+async def send_response(message: discord.Message, interaction: Optional[discord.Interaction], stream: Optional[StreamingReply],
+                        messages: list[Message], text: str, started: float):
+    """Sends the generated reply and stores it with the messages it answers"""
+    if stream is not None:
+        reply = await stream.finish(text)
+    elif interaction is not None:
         reply = await interaction.followup.send(text)
     else:
         reply = await message.reply(text)
+    print(f"Response time: {time.monotonic() - started:.2f}s, average wait for a slot: {client.scheduler.stats()['average_wait']:.2f}s")
     
     idx = messages.index(message.id)
     new_messages = messages[:idx]
@@ -146,10 +526,12 @@ async def respond(message: discord.Message, *, interaction: Optional[discord.Int
     for x in new_messages:
         cache[x.id] = x
 
-    msg = Message(reply.id, messages[0].id, 'assistant', text)
+    msg = Message(reply.id, messages[0].id, 'assistant', text, channel=reply.channel.id)
     await client.mysql.insert_message(msg)
     cache[reply.id] = msg
     last_message[reply.channel.id] = reply.id
+    if client.config.summarization:
+        run_in_background(update_summary(messages, message.channel.id))
 
 @tree.command(name="continue")
 @discord.app_commands.describe(message="ID of message to continue from, defaults to last message sent by bot in the channel")
@@ -191,6 +573,40 @@ class ExceptView(discord.ui.View):
         await interaction.response.defer(thinking=True)
         await respond(self.message, interaction=interaction)
 
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def is_youtube_url(url: str) -> bool:
+    host = urlparse(url).hostname or ''
+    return host == 'youtube.com' or host.endswith('.youtube.com')
+
+async def prefetch_youtube(urls: list[str]):
+    """Fetch video metadata for load_url in one request, the model will most likely call it for these links"""
+    def prefetch():
+        # importing load_url loads bs4, replicate and httpx, keep that off the event loop
+        from abbas.tools.load_url import prefetch_youtube
+        prefetch_youtube(urls)
+    try:
+        await asyncio.to_thread(prefetch)
+    except Exception:
+        print("WARNING: Failed to prefetch YouTube videos")
+        print_exc()
+
+async def update_summary(messages: list[Message], channel_id: int):
+    """Summarize messages that no longer fit in the context, so the next response still knows about them"""
+    try:
+        async with client.scheduler.slot(channel_id):
+            msg = await client.responder.summarize(messages)
+        if msg is not None:
+            await client.mysql.update_summary(msg.id, msg.summary)
+            print(f"Updated conversation summary at message {msg.id}")
+    except Exception:
+        print("WARNING: Failed to update conversation summary")
+        print_exc()
+
 async def get_message(channel: discord.abc.Messageable | int, message_id: int):
     msg = client._get_state()._get_message(message_id)
     if msg is None:
@@ -199,33 +615,56 @@ async def get_message(channel: discord.abc.Messageable | int, message_id: int):
         msg = await channel.fetch_message(message_id)
     return msg
 
-async def create_message_list(message: discord.Message) -> list[Message]:
+async def cached_message_list(message_id: int) -> list[Message]:
+    """Create a list of Message objects from a message in the cache and its parents"""
+    messages = []
+    parent = message_id
+    while parent:
+        if parent not in cache:
+            # the older part of a conversation loaded at startup may be missing
+            older = await client.mysql.fetch_message_list(parent)
+            for x in older:
+                cache.setdefault(x.id, x)
+            messages += older
+            break
+        msg = cache[parent]
+        parent = msg.parent
+        messages.append(msg)
+    return messages
+
+async def create_message_list(message: discord.Message, *, stored: bool = False) -> list[Message]:
     """
     Create a list of Message objects parenting a Discord message.
 
     This function will try to retrieve the message list from MySQL. If they don't exist in the database, it will fetch them from Discord.
     It will automatically update the database and uses caching to prevent unnecessary database calls.
+    Set stored for messages that may have been answered before, like the ones /continue and Retry answer, to look them up as well.
     """
     # Resolve message list from cache
     if message.id in cache:
-        msg = cache[message.id]
-        parent = msg.parent
-        messages = [msg]
-        while parent:
-            msg = cache[parent]
-            parent = msg.parent
-            messages.append(msg)
-        return messages
+        return await cached_message_list(message.id)
 
     ref = message.reference.message_id if message.reference else None
+    if stored and ref not in cache:
+        # the message itself is stored if it was answered before
+        messages = await client.mysql.fetch_message_list(message.id)
+        if messages:
+            for x in messages:
+                if not x in cache:
+                    cache[x.id] = x
+            return messages
+
     username = message.author.display_name
     if message.author == client.user:
         username = 'assistant'
     elif username.lower() == 'assistant' or username.lower() == 'system':
         username = 'user'
-    messages = [Message(message.id, ref, username, message.clean_content)]
+    messages = [Message(message.id, ref, username, message.clean_content, channel=message.channel.id)]
     if not ref:
         return messages
+    if ref in cache:
+        # a reply in a conversation that was answered since startup or loaded by the warm-up
+        return messages + await cached_message_list(ref)
     # Fetch messages from MySQL
     messages += await client.mysql.fetch_message_list(ref)
 
@@ -240,7 +679,7 @@ async def create_message_list(message: discord.Message) -> list[Message]:
                 username = 'assistant'
             elif username.lower() == 'assistant' or username.lower() == 'system':
                 username = 'user'
-            messages.append(Message(x.id, ref, username, x.clean_content))
+            messages.append(Message(x.id, ref, username, with_cached_captions(x), channel=x.channel.id))
         await client.mysql.insert_messages(messages[1:])
     
     # Add messages to cache
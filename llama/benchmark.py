@@ -0,0 +1,86 @@
+"""
+Compares token counting throughput of Tokenizer.encode with the whitespace run scan it used before,
+on message sizes seen on Discord.
+
+Usage: python -m llama.benchmark [path to tokenizer.model]
+"""
+import sys
+import time
+import random
+from typing import Callable, Iterator
+
+from llama.tokenizer import Tokenizer
+
+WORDS = ("hej", "abbas", "co", "tam", "słychać", "dzięki", "wiesz", "że", "ten", "szejk", "ma", "złoto",
+         "lol", "xD", "https://example.com/a?b=c", "😂", "nie", "wiem", "pytanie", "odpowiedź")
+
+def _split_per_char(s: str, max_consecutive_slice_len: int) -> Iterator[str]:
+    """The per-character scan Tokenizer used before the fast path, as the baseline"""
+    current_slice_len = 0
+    current_slice_is_space = s[0].isspace() if len(s) > 0 else False
+    slice_start = 0
+    for i in range(len(s)):
+        is_now_space = s[i].isspace()
+
+        if current_slice_is_space ^ is_now_space:
+            current_slice_len = 1
+            current_slice_is_space = is_now_space
+        else:
+            current_slice_len += 1
+            if current_slice_len > max_consecutive_slice_len:
+                yield s[slice_start:i]
+                slice_start = i
+                current_slice_len = 1
+    yield s[slice_start:]
+
+def message(rng: random.Random, length: int) -> str:
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        if rng.random() < 0.05:
+            word += "\n"
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length]
+
+def samples(rng: random.Random) -> dict[str, list[str]]:
+    return {
+        "short (40 chars)": [message(rng, 40) for _ in range(2000)],
+        "typical (250 chars)": [message(rng, 250) for _ in range(1000)],
+        "Discord limit (2000 chars)": [message(rng, 2000) for _ in range(200)],
+        # pasted logs or code end up in image captions and tool results
+        "paste (40000 chars)": [message(rng, 40000) + " " * 30000 for _ in range(5)],
+    }
+
+def throughput(token_len: Callable[[str], int], texts: list[str], min_time: float = 1.0) -> float:
+    """Characters counted per second"""
+    chars = sum(len(text) for text in texts)
+    rounds = 0
+    started = time.perf_counter()
+    while True:
+        for text in texts:
+            token_len(text)
+        rounds += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return chars * rounds / elapsed
+
+def main(model_path: str):
+    tt = Tokenizer(model_path)
+    token_len = lambda text: len(tt.encode(text, bos=False, eos=False, allowed_special="all"))
+    fast = Tokenizer._split_whitespaces_or_nonwhitespaces
+    for name, texts in samples(random.Random(0)).items():
+        expected = [token_len(text) for text in texts]
+        new = throughput(token_len, texts)
+        Tokenizer._split_whitespaces_or_nonwhitespaces = staticmethod(_split_per_char)
+        try:
+            if [token_len(text) for text in texts] != expected:
+                raise AssertionError(f"Token counts differ for {name}")
+            old = throughput(token_len, texts)
+        finally:
+            Tokenizer._split_whitespaces_or_nonwhitespaces = staticmethod(fast)
+        print(f"{name:<28} per-char scan: {old / 1e6:7.2f} MB/s   fast path: {new / 1e6:7.2f} MB/s   {new / old:5.2f}x")
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "llama/tokenizer.model")